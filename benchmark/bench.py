@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# Runs user_creation.py against mock_aem.py and records requests per user, throughput and peak memory.
+#
+#   python3 benchmark/bench.py --sizes 1000,10000 --latency 0.005
+#
+# Every scenario runs user_creation.py as a subprocess in a temporary directory with a generated
+# config/user_creation.yaml. Results are appended to benchmark/results.jsonl and compared with the
+# previous result of the same scenario.
+from optparse import OptionParser
+import csv
+import json
+import os
+import pathlib
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import yaml
+
+here = pathlib.Path(__file__).resolve().parent
+script = here.parent / "user_creation.py"
+base_config = here.parent / "config" / "user_creation.yaml"
+
+parser = OptionParser()
+parser.add_option("--sizes", dest="sizes", default="1000,10000,100000", help="numbers of users, separated by comma")
+parser.add_option("--scenarios", dest="scenarios", default="import,reimport,export,compare")
+parser.add_option("--latency", type="float", dest="latency", default=0.0, help="seconds added to every response of the mock")
+parser.add_option("--error_rate", type="float", dest="error_rate", default=0.0)
+parser.add_option("--workers", type="int", dest="workers", default=8)
+parser.add_option("--args", dest="args", default="", help="extra arguments of user_creation.py, e.g. \"--batch_members\"")
+parser.add_option("--results", dest="results", default=str(here / "results.jsonl"))
+parser.add_option("--tolerance", type="float", dest="tolerance", default=0.2, help="slowdown reported as a regression")
+
+groups = ["administrators", "contributor", "dam-users", "content-authors"]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class MockServer:
+
+    def __init__(self, users=0, seed=1, latency=0.0, error_rate=0.0):
+        self.port = free_port()
+        self.process = subprocess.Popen([
+                sys.executable, str(here / "mock_aem.py"),
+                "--port", str(self.port),
+                "--users", str(users),
+                "--seed", str(seed),
+                "--latency", str(latency),
+                "--error_rate", str(error_rate)
+            ])
+
+        # seeding 100k users takes a few seconds
+        for i in range(600):
+            try:
+                self.stats()
+                return
+            except OSError:
+                time.sleep(0.1)
+
+        raise RuntimeError("mock_aem.py didn't start")
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def stats(self):
+        with urllib.request.urlopen(f"{self.url}/stats") as r:
+            return json.load(r)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+def write_userlist(path, size):
+    # LOCAL and STAGE use the names of the seeded users, so that export and compare find them
+    rand = random.Random(1)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["givenName", "familyName", "email", "groups", "password", "LOCAL", "STAGE"])
+        for i in range(size):
+            writer.writerow([f"G{i}", f"F{i}", f"user{i}@example.com", "|".join(rand.sample(groups, rand.randint(1, 2))), f"password{i}", f"user{i}", f"user{i}"])
+
+    return
+
+def write_config(workdir, servers):
+    with open(base_config, encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    config["userlist"] = "users.csv"
+    config["work_dir"] = "tmp"
+    config["environment"] = [
+            {"name": name, "url": server.url, "user": "admin", "password": "admin", "workers": options.workers}
+            for name, server in servers.items()
+        ]
+
+    os.makedirs(workdir / "config", exist_ok=True)
+    with open(workdir / "config" / "user_creation.yaml", "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f)
+
+    return
+
+def run_tool(workdir, args):
+    # os.wait4 gives the peak RSS of this process alone
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, str(script)] + args, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - started
+
+    if not os.waitstatus_to_exitcode(status) == 0:
+        sys.stderr.write(stderr.decode(errors="replace")[-2000:])
+        raise RuntimeError(f"user_creation.py {' '.join(args)} failed")
+
+    return elapsed, usage.ru_maxrss * 1024
+
+def run_scenario(scenario, size):
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="bench-"))
+    extra = options.args.split()
+    servers = {}
+    try:
+        write_userlist(workdir / "users.csv", size)
+
+        if scenario in ["import", "reimport"]:
+            servers = {"LOCAL": MockServer(0, 1, options.latency, options.error_rate)}
+            args = ["--mode", "import", "--target", "LOCAL", "--execute"] + extra
+        elif scenario == "export":
+            servers = {"LOCAL": MockServer(size, 1, options.latency, options.error_rate)}
+            args = ["--mode", "export", "--target", "LOCAL"] + extra
+        else:
+            # the environments are seeded differently, so that memberships differ
+            servers = {
+                "LOCAL": MockServer(size, 1, options.latency, options.error_rate),
+                "STAGE": MockServer(size, 2, options.latency, options.error_rate)
+            }
+            args = ["--mode", "compare", "--target", "LOCAL,STAGE"] + extra
+
+        write_config(workdir, servers)
+        if scenario == "reimport":
+            # the second import of the same csv should write nothing
+            run_tool(workdir, args)
+            for server in servers.values():
+                urllib.request.urlopen(f"{server.url}/stats?reset=true").read()
+
+        elapsed, peak = run_tool(workdir, args)
+
+        stats = [server.stats() for server in servers.values()]
+        requests = sum([s["requests"] for s in stats])
+        by = {}
+        for s in stats:
+            for key, count in s["by"].items():
+                by[key] = by.get(key, 0) + count
+    finally:
+        for server in servers.values():
+            server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "scenario": scenario,
+        "users": size,
+        "seconds": round(elapsed, 3),
+        "users_per_second": round(size / elapsed, 1),
+        "requests": requests,
+        "requests_per_user": round(requests / size, 3),
+        "requests_by": by,
+        "peak_rss_mb": round(peak / 1024 / 1024, 1)
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_results(path):
+    previous = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                previous[(result["scenario"], result["users"], result["options"])] = result
+
+    return previous
+
+def compare(result, previous):
+    # slower runs and more requests than the previous result of the same scenario are regressions
+    regressions = []
+    if result["scenario"] == "reimport":
+        # the second import of the same csv must not write anything
+        writes = result["requests_by"].get("create", 0) + result["requests_by"].get("members", 0)
+        if writes:
+            regressions.append(f"reimport sent {writes} write requests")
+
+    if previous is None:
+        return "REGRESSION " + ", ".join(regressions) if regressions else "new"
+
+    if result["seconds"] > previous["seconds"] * (1 + options.tolerance):
+        regressions.append(f"seconds {previous['seconds']} -> {result['seconds']}")
+    if result["requests"] > previous["requests"]:
+        regressions.append(f"requests {previous['requests']} -> {result['requests']}")
+    if result["peak_rss_mb"] > previous["peak_rss_mb"] * (1 + options.tolerance):
+        regressions.append(f"peak_rss_mb {previous['peak_rss_mb']} -> {result['peak_rss_mb']}")
+
+    return "REGRESSION " + ", ".join(regressions) if regressions else "ok"
+
+def main():
+    previous = previous_results(options.results)
+    revision = git_revision()
+    key = f"latency={options.latency} error_rate={options.error_rate} workers={options.workers} {options.args}".strip()
+
+    regressed = False
+    with open(options.results, "a", encoding="utf-8") as f:
+        for size in [int(size) for size in options.sizes.split(",")]:
+            for scenario in options.scenarios.split(","):
+                result = run_scenario(scenario, size)
+                result.update({"revision": revision, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "options": key})
+                verdict = compare(result, previous.get((scenario, size, key)))
+                regressed = regressed or verdict.startswith("REGRESSION")
+
+                print(f"{scenario:9} {size:>7} users: {result['seconds']:>8}s {result['users_per_second']:>9} users/s "
+                      f"{result['requests_per_user']:>6} req/user {result['peak_rss_mb']:>7} MB  {verdict}", flush=True)
+                f.write(json.dumps(result) + "\n")
+
+    sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# A local stand-in of the AEM endpoints which user_creation.py uses:
+#   /bin/querybuilder.json                      path, path.self, type, property, daterange, p.* predicates
+#   /libs/granite/security/post/authorizables   createUser
+#   <group path>.rw.html                        addMembers / removeMembers
+#   <path>.<depth>.json                         node reads
+#   /stats                                      request counts, /stats?reset=true clears them
+from optparse import OptionParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import bisect
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+import re
+
+parser = OptionParser()
+parser.add_option("--port", type="int", dest="port", default=4502)
+parser.add_option("--latency", type="float", dest="latency", default=0.0, help="seconds added to every response")
+parser.add_option("--error_rate", type="float", dest="error_rate", default=0.0, help="ratio of requests answered with 503")
+parser.add_option("--lost_rate", type="float", dest="lost_rate", default=0.0, help="ratio of writes which are applied, but answered with 503")
+parser.add_option("--users", type="int", dest="users", default=0, help="number of seeded users named user<n>")
+parser.add_option("--groups", type="int", dest="groups", default=10, help="number of seeded groups named group<n>")
+parser.add_option("--memberships", type="int", dest="memberships", default=2, help="maximum groups of each seeded user")
+parser.add_option("--seed", type="int", dest="seed", default=1)
+
+def oak_uuid(authorizable_id):
+    # Oak derives jcr:uuid of an authorizable from its lowercased id
+    return str(uuid.UUID(bytes=hashlib.md5(authorizable_id.lower().encode()).digest(), version=3))
+
+def now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+class Repository:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.paths = []
+        self.by_id = {}
+        self.by_uuid = {}
+        self.stats = {"requests": 0, "by": {}}
+
+        return
+
+    def add(self, kind, authorizable_id, given_name=None, **properties):
+        folder = "users" if kind == "rep:User" else "groups"
+        path = f"/home/{folder}/{authorizable_id[0]}/{authorizable_id}"
+        node = {
+            "jcr:primaryType": kind,
+            "jcr:path": path,
+            "jcr:uuid": oak_uuid(authorizable_id),
+            "jcr:lastModified": now(),
+            "rep:authorizableId": authorizable_id,
+            "rep:principalName": authorizable_id
+        }
+        if kind == "rep:Group":
+            node["rep:members"] = []
+        if given_name:
+            node["profile"] = {"givenName": given_name}
+        node.update(properties)
+
+        self.nodes[path] = node
+        bisect.insort(self.paths, path)
+        self.by_id[authorizable_id] = node
+        self.by_uuid[node["jcr:uuid"]] = node
+
+        return node
+
+    def seed(self, opt):
+        for name, given_name in [("administrators", None), ("contributor", "Contributors"), ("dam-users", "DAM Users"), ("content-authors", "Authors")]:
+            self.add("rep:Group", name, given_name)
+        groups = [self.add("rep:Group", f"group{i}") for i in range(opt.groups)]
+
+        rand = random.Random(opt.seed)
+        for i in range(opt.users):
+            user = self.add("rep:User", f"user{i}", f"G{i}")
+            for group in rand.sample(groups, min(len(groups), rand.randint(0, opt.memberships))):
+                group["rep:members"].append(user["jcr:uuid"])
+
+        return
+
+    def count(self, key):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["by"][key] = self.stats["by"].get(key, 0) + 1
+
+        return
+
+    def under(self, path):
+        # nodes below a path, in path order
+        start = bisect.bisect_left(self.paths, path + "/")
+        for i in range(start, len(self.paths)):
+            if not self.paths[i].startswith(path + "/"):
+                break
+            yield self.nodes[self.paths[i]]
+
+    def query(self, params):
+        get = lambda key, default=None: params.get(key, [default])[0]
+
+        with self.lock:
+            if get("property") in ["rep:authorizableId", "jcr:uuid"] and not get("property.value") is None:
+                index = self.by_id if get("property") == "rep:authorizableId" else self.by_uuid
+                node = index.get(get("property.value"))
+                hits = [node] if node is not None and node["jcr:path"].startswith(get("path", "/")) else []
+            elif get("path.self") == "true":
+                hits = [self.nodes[get("path")]] if get("path") in self.nodes else []
+            else:
+                hits = self.under(get("path", ""))
+
+            hits = [node for node in hits if get("type") is None or node["jcr:primaryType"] == get("type")]
+            if get("property") and not get("property") in ["rep:authorizableId", "jcr:uuid"]:
+                value = get("property.value")
+                hits = [node for node in hits if value in node.get(get("property"), []) or node.get(get("property")) == value]
+            if get("daterange.property"):
+                hits = [node for node in hits if node.get(get("daterange.property"), "") > get("daterange.lowerBound", "")]
+
+            total = len(hits)
+            offset = int(get("p.offset", 0))
+            limit = int(get("p.limit", 10))
+            hits = hits[offset:] if limit < 0 else hits[offset:offset + limit]
+
+            if get("p.hits") == "selective":
+                hits = [select(node, get("p.properties", "").split()) for node in hits]
+            else:
+                hits = [json.loads(json.dumps(node)) for node in hits]
+
+        return {"success": True, "results": len(hits), "total": total, "more": offset + len(hits) < total, "offset": offset, "hits": hits}
+
+    def create_user(self, form):
+        authorizable_id = form["authorizableId"][0]
+        with self.lock:
+            if authorizable_id in self.by_id:
+                return False
+            self.add("rep:User", authorizable_id, form.get("profile/givenName", [None])[0], **{"rep:password": form.get("rep:password", [""])[0]})
+
+        return True
+
+    def update_members(self, path, form):
+        with self.lock:
+            group = self.nodes.get(path)
+            if group is None or not group["jcr:primaryType"] == "rep:Group":
+                return False
+
+            for authorizable_id in form.get("addMembers", []):
+                if authorizable_id in self.by_id and not self.by_id[authorizable_id]["jcr:uuid"] in group["rep:members"]:
+                    group["rep:members"].append(self.by_id[authorizable_id]["jcr:uuid"])
+            for authorizable_id in form.get("removeMembers", []):
+                if authorizable_id in self.by_id and self.by_id[authorizable_id]["jcr:uuid"] in group["rep:members"]:
+                    group["rep:members"].remove(self.by_id[authorizable_id]["jcr:uuid"])
+            group["jcr:lastModified"] = now()
+
+        return True
+
+def select(node, properties):
+    # p.hits=selective, "profile/givenName" is read from the nested profile
+    hit = {}
+    for name in properties:
+        if "/" in name:
+            parent, child = name.split("/", 1)
+            if child in node.get(parent, {}):
+                hit[name] = node[parent][child]
+        elif name in node:
+            hit[name] = node[name]
+
+    return hit
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json"):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def failed(self, rate):
+        if rate and random.random() < rate:
+            repository.count("error")
+            self.send(503, "busy", "text/html")
+            return True
+
+        return False
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/stats":
+            with repository.lock:
+                body = json.dumps(repository.stats)
+                if params.get("reset") == ["true"]:
+                    repository.stats = {"requests": 0, "by": {}}
+            return self.send(200, body)
+
+        time.sleep(options.latency)
+        if self.failed(options.error_rate):
+            return
+
+        if url.path == "/bin/querybuilder.json":
+            repository.count("querybuilder")
+            return self.send(200, json.dumps(repository.query(params)))
+
+        m = re.match(r"^(.*)\.(\d+|infinity)\.json$", url.path)
+        if m:
+            repository.count("node")
+            with repository.lock:
+                node = repository.nodes.get(m.group(1))
+                body = json.dumps(node)
+            if node is None:
+                return self.send(404, "{}")
+            return self.send(200, body)
+
+        self.send(404, "{}")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode(), keep_blank_values=True)
+
+        time.sleep(options.latency)
+        if self.failed(options.error_rate):
+            return
+
+        if url.path == "/libs/granite/security/post/authorizables":
+            repository.count("create")
+            if not repository.create_user(form):
+                # AEM answers 500 when the authorizable exists
+                return self.send(500, "exists", "text/html")
+            if self.failed(options.lost_rate):
+                return
+            return self.send(201, "created", "text/html")
+
+        if url.path.endswith(".rw.html"):
+            repository.count("members")
+            if not repository.update_members(url.path[:-len(".rw.html")], form):
+                return self.send(404, "not found", "text/html")
+            if self.failed(options.lost_rate):
+                return
+            return self.send(200, "ok", "text/html")
+
+        self.send(404, "{}")
+
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+
+    repository = Repository()
+    repository.seed(options)
+
+    ThreadingHTTPServer(("127.0.0.1", options.port), Handler).serve_forever()
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+import user_creation
+
+
+def directories():
+    # one existing user, member of contributor and dam-users
+    uuid = user_creation.oak_uuid("existing")
+    users = user_creation.UserDirectory([
+        {"jcr:path": "/home/users/e/existing", "rep:authorizableId": "existing", "jcr:uuid": uuid}
+    ])
+    groups = user_creation.GroupDirectory([
+        {"jcr:path": f"/home/groups/{name[0]}/{name}", "rep:authorizableId": name, "jcr:uuid": user_creation.oak_uuid(name), "rep:members": members}
+        for name, members in [("contributor", [uuid]), ("dam-users", [uuid]), ("administrators", [])]
+    ])
+
+    return users, groups
+
+
+def plan(*rows):
+    plan = user_creation.ImportPlan(*directories())
+    for line, (username, groups) in enumerate(rows, start=2):
+        plan.add(user_creation.UserRecord(line, username, "", "", "", groups, "", [username]), io.StringIO())
+
+    return plan
+
+
+def test_removes_only_groups_of_the_scope():
+    import_plan = plan(("existing", "contributor"))
+
+    import_plan.reconcile({"contributor"})
+    assert import_plan.removes == {}
+    assert import_plan.unchanged == 1
+
+    import_plan = plan(("existing", "contributor"))
+    import_plan.reconcile({"contributor", "dam-users"})
+    assert import_plan.removes == {"dam-users": ["existing"]}
+    assert import_plan.unchanged == 0
+
+
+def test_rejects_users_on_several_rows():
+    import_plan = plan(("existing", "contributor"), ("existing", "dam-users"))
+
+    with pytest.raises(user_creation.UserMigrationError, match="existing"):
+        import_plan.reconcile({"contributor", "dam-users"})
+
+
+def test_keeps_memberships_of_rows_with_unknown_groups():
+    import_plan = plan(("existing", "administrators|missing"), ("newuser", "contributor"))
+
+    import_plan.reconcile({"contributor", "dam-users", "administrators"})
+    assert import_plan.removes == {}
+    assert import_plan.skipped == 1
+    assert import_plan.unknown == {"missing": 1}
+    assert import_plan.creates == {"newuser"}
+    assert import_plan.adds == {"contributor": 1}
@@ -0,0 +1,56 @@
+import xml.etree.ElementTree as ET
+import zipfile
+
+import user_creation
+
+
+def build_package(tmp_path, monkeypatch):
+    # a snapshot with one group and one existing member, and a csv with a new user of that group
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "work" / "LOCAL").mkdir(parents=True)
+    (tmp_path / "work" / "snapshots").mkdir()
+
+    snapshot = user_creation.Snapshot(str(tmp_path / "work" / "snapshots" / "LOCAL.sqlite"))
+    snapshot.update([
+        {
+            "jcr:path": "/home/users/e/existing",
+            "jcr:primaryType": "rep:User",
+            "rep:authorizableId": "existing",
+            "rep:principalName": "existing",
+            "jcr:uuid": user_creation.oak_uuid("existing")
+        },
+        {
+            "jcr:path": "/home/groups/c/contributor",
+            "jcr:primaryType": "rep:Group",
+            "rep:authorizableId": "contributor",
+            "rep:principalName": "contributor",
+            "jcr:uuid": user_creation.oak_uuid("contributor"),
+            "rep:members": [user_creation.oak_uuid("existing")]
+        }
+    ])
+    snapshot.close()
+
+    (tmp_path / "users.csv").write_text(
+        "givenName,familyName,email,groups,password,LOCAL\n"
+        "Thomas,Andersson,thomas@example.com,contributor,secret,thomas\n",
+        encoding="utf-8"
+    )
+
+    config = {"work_dir": "work", "workers": 1}
+    userlist = user_creation.UserlistReader("users.csv", "LOCAL", "package")
+
+    return user_creation.package_target(config, "LOCAL", userlist)
+
+
+def test_filter_modes(tmp_path, monkeypatch):
+    path = build_package(tmp_path, monkeypatch)
+
+    with zipfile.ZipFile(path) as package:
+        filters = ET.fromstring(package.read("META-INF/vault/filter.xml"))
+        group = package.read("jcr_root/home/groups/c/contributor/.content.xml").decode("utf-8")
+
+    # new users are merged below the root, existing groups are updated with their full member list
+    modes = {element.get("root"): element.get("mode") for element in filters.iter("filter")}
+    assert modes == {"/home/users/imported": "merge", "/home/groups/c/contributor": "update"}
+    assert user_creation.oak_uuid("existing") in group
+    assert user_creation.oak_uuid("thomas") in group
@@ -0,0 +1,26 @@
+import user_creation
+
+
+def test_iterated_digest():
+    # salt "ab" and password "c" digest "abc", the SHA-256 test vector of FIPS 180-2
+    assert user_creation.oak_password_hash("c", "SHA-256", 1, salt="ab") == \
+        "{SHA-256}ab-ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+
+
+def test_pbkdf2():
+    # salt "73616c74" is b"salt", the first 128 bits of the PBKDF2-HMAC-SHA1 test vectors of RFC 6070
+    assert user_creation.oak_password_hash("password", "PBKDF2WithHmacSHA1", 1, salt="73616c74") == \
+        "{PBKDF2WithHmacSHA1}73616c74-0c60c80f961f0e71f3a9b524af601206"
+    assert user_creation.oak_password_hash("password", "PBKDF2WithHmacSHA1", 4096, salt="73616c74") == \
+        "{PBKDF2WithHmacSHA1}73616c74-4096-4b007901b765489abead49d926f721d0"
+
+
+def test_random_salt():
+    first = user_creation.oak_password_hash("secret", "SHA-256", 1000, 8)
+    second = user_creation.oak_password_hash("secret", "SHA-256", 1000, 8)
+
+    assert first.startswith("{SHA-256}")
+    assert len(first.split("}")[1].split("-")[0]) == 16
+    assert first != second
+    assert user_creation.is_password_hash(first)
+    assert user_creation.hash_password(first, {"algorithm": "SHA-256", "iterations": 1000, "salt_size": 8}) == first
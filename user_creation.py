@@ -1,26 +1,25 @@
 # -*- coding: utf-8 -*-
+# requests, yaml, dictknife, sqlite3, asyncio and concurrent.futures are imported where they are used,
+# so that importing this module is fast and has no side effect
 from optparse import OptionParser
 import sys
 import shutil
 import os
 import pathlib
 import csv
-import re
 import time
-from functools import reduce
-import subprocess
-import multiprocessing
-import requests
+import random
+import math
+import functools
+import contextlib
+import bisect
+from collections import namedtuple, deque
+import itertools
+import threading
 import urllib.parse
-import yaml
 import json
+from datetime import datetime, timezone
 import logging
-import logging.handlers
-from tabulate import tabulate
-from dictknife import deepmerge
-import pprint
-
-
 
 
 # define global variables
@@ -29,45 +28,63 @@ filename = os.path.splitext(_filename)[0]
 subdir = f"{filename}"
 config_file = str(pathlib.Path(f"./config/{filename}.yaml"))
 
-# define logger
+# define logger, handlers are added by setup_logging
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-rh = logging.handlers.RotatingFileHandler(
-        f'{filename}.log', 
-        encoding='utf-8',
-        maxBytes=1024000,
-        backupCount=2
-    )
-rh_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s')
-rh.setFormatter(rh_formatter)
-log.addHandler(rh)
-
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch_formatter = logging.Formatter('%(levelname)s - %(message)s')
-ch.setFormatter(ch_formatter)
-log.addHandler(ch)
 
-
-
-# define global variables
-url=""
-user=""
-password=""
+def setup_logging():
+    import logging.handlers
+
+    # the handlers are added once, also when a scheduler calls this for every run
+    if any([getattr(handler, "user_creation", False) for handler in log.handlers]):
+        return log
+
+    log.setLevel(logging.DEBUG)
+    rh = logging.handlers.RotatingFileHandler(
+            f'{filename}.log', 
+            encoding='utf-8',
+            maxBytes=1024000,
+            backupCount=2
+        )
+    rh_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s')
+    rh.setFormatter(rh_formatter)
+    rh.user_creation = True
+    log.addHandler(rh)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch_formatter = logging.Formatter('%(levelname)s - %(message)s')
+    ch.setFormatter(ch_formatter)
+    ch.user_creation = True
+    log.addHandler(ch)
+
+    return log
 
 # define option parser
 parser = OptionParser()
 parser.add_option("-u", "--userlist", dest="userlist")
 parser.add_option("-w", "--work_dir", dest="work_dir")
-parser.add_option("-m", "--mode", dest="mode", help="mode: export or import")
+parser.add_option("-m", "--mode", dest="mode", help="mode: export, import, reconcile, package or compare")
 parser.add_option("-d", "--dryrun", action="store_true", dest="dryrun", default=True)
 parser.add_option("-e", "--execute", action="store_false", dest="dryrun")
 parser.add_option("-t", "--target", dest="target")
-
-# load config
-with open(config_file, "r", encoding="utf-8") as file:
-    config = yaml.safe_load(file)
-    (options, args) = parser.parse_args()
+parser.add_option("--workers", type="int", dest="workers", help="number of users imported in parallel")
+parser.add_option("--async", action="store_true", dest="use_async", default=False, help="use the asyncio client")
+parser.add_option("--batch_members", action="store_true", dest="batch_members", default=False, help="add members to each group in batched requests")
+parser.add_option("--resume", action="store_true", dest="resume", default=False, help="skip users and memberships recorded in the journal")
+parser.add_option("--snapshot", action="store_true", dest="snapshot", default=False, help="refresh the local snapshot of the target and export from it")
+parser.add_option("--profile", dest="profile", help="profile the run: cpu or mem, reports are written to work_dir")
+parser.add_option("--hash_passwords", action="store_true", dest="hash_passwords", default=False, help="send Oak password hashes instead of plaintext passwords")
+parser.add_option("--output", dest="output", help="export to <work_dir>/<target>/export.csv or export.jsonl: csv or jsonl")
+parser.add_option("--gzip", action="store_true", dest="gzip", default=False, help="compress the export file")
+parser.add_option("--offline", action="store_true", dest="offline", default=False, help="read local snapshots instead of the environments")
+
+def load_config(args=None, path=None):
+    # args are parsed like the command line, sys.argv is used when they are not given
+    import yaml
+
+    with open(path or config_file, "r", encoding="utf-8") as file:
+        config = yaml.safe_load(file)
+    (options, args) = parser.parse_args(args)
     if not options.userlist == None:
         config["userlist"] = options.userlist
 
@@ -80,9 +97,46 @@ with open(config_file, "r", encoding="utf-8") as file:
     if not "dryrun" in config:
         config["dryrun"] = options.dryrun
 
-    if not "target" == None:
+    if not options.target == None:
         config["target"] = options.target
 
+    if not options.workers == None:
+        config["workers"] = options.workers
+
+    if options.use_async:
+        config["async"] = True
+
+    if options.batch_members:
+        config["batch_members"] = True
+
+    if options.resume:
+        config["resume"] = True
+
+    if options.snapshot:
+        config["snapshot"] = True
+
+    if options.offline:
+        config["offline"] = True
+
+    if options.hash_passwords:
+        config["hash_passwords"] = True
+
+    if not options.output == None:
+        config["output"] = options.output
+
+    if options.gzip:
+        config["gzip"] = True
+
+    if not options.profile == None:
+        config["profile"] = options.profile
+
+    return config
+
+def deepmerge(*dicts, **kwargs):
+    from dictknife import deepmerge as merge
+
+    return merge(*dicts, **kwargs)
+
 def text2dict(criteria):
     params = {}
     for line in criteria.replace(" ", "").split("\n"):
@@ -93,6 +147,461 @@ def text2dict(criteria):
         params[key] = val
     return params
 
+class AuthorizableDirectory:
+
+    # properties which an authorizable can be looked up by
+    keys = ["rep:authorizableId", "rep:principalName", "jcr:uuid", "jcr:path"]
+    # properties which are fetched to build the directory
+    properties = keys
+
+    def __init__(self, hits):
+        self.index = {key: {} for key in self.keys}
+
+        for hit in hits:
+            self.add(hit)
+
+        return
+
+    def __len__(self):
+        return len(self.index["jcr:path"])
+
+    def __iter__(self):
+        return iter(self.index["jcr:path"].values())
+
+    def add(self, hit):
+        for key in self.keys:
+            if key in hit:
+                self.index[key][hit[key]] = hit
+
+        return
+
+    def get(self, value, key=None):
+        if key is not None:
+            return self.index[key].get(value)
+
+        for key in self.keys:
+            if value in self.index[key]:
+                return self.index[key][value]
+
+        return None
+
+class UserDirectory(AuthorizableDirectory):
+    pass
+
+class GroupDirectory(AuthorizableDirectory):
+
+    properties = AuthorizableDirectory.keys + ["profile/givenName"]
+
+    def __init__(self, hits):
+        self.members = {}
+        super().__init__(hits)
+
+        return
+
+    def add(self, group):
+        super().add(group)
+
+        # invert rep:members, so that the groups of a user are found by its jcr:uuid
+        members = group.get("rep:members", [])
+        if isinstance(members, str):
+            members = [members]
+        for member in members:
+            self.members.setdefault(member, []).append(group)
+
+        return
+
+    def groups_having(self, uuid):
+        return self.members.get(uuid, [])
+
+def given_name(hit):
+    # selective hits have "profile/givenName", full hits and node reads have a nested profile
+    if "profile/givenName" in hit:
+        return hit["profile/givenName"]
+
+    return hit.get("profile", {}).get("givenName")
+
+def group_display_name(group):
+    name = given_name(group)
+    if name:
+        return name
+
+    return group["rep:authorizableId"]
+
+def hit_params(criteria, properties=None):
+    # only the declared properties are returned, instead of the full nodes
+    params = {"p.hits": "full", "p.limit": "-1"}
+    if properties:
+        params = {"p.hits": "selective", "p.properties": " ".join(properties), "p.limit": "-1"}
+
+    return deepmerge(params, criteria)
+
+class Phases:
+
+    # time of the threaded client is split into named phases when --profile is given,
+    # a nested phase pauses the enclosing one, so that every second is counted once
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = {}
+        self.functions = {}
+
+        return
+
+    def register(self, name, func):
+        self.functions.setdefault(name, []).append(func)
+
+        return func
+
+    def measure(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+
+        return self.measuring(name)
+
+    @contextlib.contextmanager
+    def measuring(self, name):
+        stack = self.local.__dict__.setdefault("stack", [])
+        now = (time.perf_counter(), time.thread_time())
+        if stack:
+            self.add(stack[-1][0], now, stack[-1][1], 0)
+        stack.append((name, now))
+        try:
+            yield
+        finally:
+            now = (time.perf_counter(), time.thread_time())
+            self.add(name, now, stack.pop()[1], 1)
+            if stack:
+                stack[-1] = (stack[-1][0], now)
+
+    def add(self, name, now, since, calls):
+        with self.lock:
+            total = self.totals.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            total["calls"] += calls
+            total["wall"] += now[0] - since[0]
+            total["cpu"] += now[1] - since[1]
+
+        return
+
+phases = Phases()
+
+def phase(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def measured(*args, **kwargs):
+            with phases.measure(name):
+                return func(*args, **kwargs)
+
+        phases.register(name, func)
+        return measured
+
+    return decorate
+
+class UserMigrationError(Exception):
+    pass
+
+class RetryPolicy:
+
+    # attempts: tries per request, backoff: first delay in seconds, budget: retries per run
+    defaults = {
+        "attempts": 5,
+        "backoff": 0.5,
+        "max_backoff": 30,
+        "budget": 1000
+    }
+
+    # 500 is not retried, because the authorizables endpoint answers 500 for an existing user
+    statuses = [429, 502, 503, 504]
+
+    def __init__(self, opt):
+        self.opt = deepmerge(self.defaults, opt)
+        self.lock = threading.Lock()
+        self.retries = 0
+
+        return
+
+    def allow(self, attempt):
+        if attempt + 1 >= self.opt["attempts"]:
+            return False
+
+        with self.lock:
+            if self.retries >= self.opt["budget"]:
+                log.warning("retry budget of this run is used up")
+                return False
+            self.retries += 1
+
+        return True
+
+    def delay(self, attempt, retry_after=None):
+        # exponential backoff with full jitter, or the delay which the server asked for
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.opt["max_backoff"])
+
+        return random.uniform(0, min(self.opt["max_backoff"], self.opt["backoff"] * 2 ** attempt))
+
+class RateController:
+
+    # AIMD concurrency control: the in-flight limit grows by one per round of good responses,
+    # and is multiplied by "decrease" on 429/503/errors or when p95 latency exceeds the target
+    defaults = {
+        "max_rps": 0,
+        "max_in_flight": 32,
+        "min_in_flight": 1,
+        "initial_in_flight": 4,
+        "target_latency": 2.0,
+        "decrease": 0.5,
+        "window": 100
+    }
+
+    def __init__(self, opt):
+        self.opt = deepmerge(self.defaults, opt)
+        self.limit = float(min(self.opt["initial_in_flight"], self.opt["max_in_flight"]))
+        self.in_flight = 0
+        self.latencies = deque(maxlen=self.opt["window"])
+        self.condition = threading.Condition()
+        self.next_slot = time.monotonic()
+        self.last_decrease = 0.0
+        self.stats = {"decreases": 0, "overloads": 0, "peak": self.limit}
+
+        return
+
+    def percentile(self, q):
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+
+        return latencies[int(q * (len(latencies) - 1))]
+
+    def acquire(self):
+        wait = 0.0
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+            # max_rps is a hard cap, requests are spaced evenly
+            if self.opt["max_rps"]:
+                now = time.monotonic()
+                wait = self.next_slot - now
+                self.next_slot = max(now, self.next_slot) + 1.0 / self.opt["max_rps"]
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return time.monotonic()
+
+    def release(self, started, overloaded=False):
+        now = time.monotonic()
+        with self.condition:
+            self.in_flight -= 1
+            self.latencies.append(now - started)
+            if overloaded:
+                self.stats["overloads"] += 1
+
+            if overloaded or (len(self.latencies) >= 10 and self.percentile(0.95) > self.opt["target_latency"]):
+                # decrease at most once per round trip, so that one burst of errors counts once
+                if now - self.last_decrease > self.percentile(0.5):
+                    self.limit = max(self.opt["min_in_flight"], self.limit * self.opt["decrease"])
+                    self.last_decrease = now
+                    self.latencies.clear()
+                    self.stats["decreases"] += 1
+                    log.debug(f"in-flight limit decreased to {int(self.limit)}")
+            else:
+                self.limit = min(self.opt["max_in_flight"], self.limit + 1.0 / self.limit)
+                self.stats["peak"] = max(self.stats["peak"], self.limit)
+
+            self.condition.notify_all()
+
+        return
+
+    def report(self):
+        return {
+            "limit": int(self.limit),
+            "peak": int(self.stats["peak"]),
+            "decreases": self.stats["decreases"],
+            "overloads": self.stats["overloads"],
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95)
+        }
+
+def operation(method, uri, params=None, data=None):
+    # requests are tagged by what they do, so that the time of a run can be split up
+    params = params or {}
+    data = data or {}
+    if uri == "/bin/querybuilder.json":
+        op = "query " + params.get("type", "nodes")
+        if "property" in params:
+            op += " by " + params["property"]
+        elif "daterange.property" in params:
+            op += " modified"
+        return op
+    if uri == "/libs/granite/security/post/authorizables":
+        return "create user"
+    if uri.endswith(".rw.html"):
+        # data is a dict or a list of tuples when a key is repeated
+        keys = {k for k, v in (data.items() if isinstance(data, dict) else data)}
+        if "addMembers" in keys and "removeMembers" in keys:
+            return "update members"
+        return "remove members" if "removeMembers" in keys else "add members"
+    if method == "GET" and uri.endswith(".json"):
+        return "node read"
+
+    return f"{method} other"
+
+class Metrics:
+
+    # upper bounds of the latency histogram in seconds, like the buckets of a prometheus histogram
+    buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")]
+
+    def __init__(self, target):
+        self.target = target
+        self.lock = threading.Lock()
+        self.ops = {}
+        self.started = time.monotonic()
+
+        return
+
+    def record(self, op, status, seconds, sent=0, received=0):
+        with self.lock:
+            m = self.ops.setdefault(op, {
+                    "count": 0,
+                    "bytes_sent": 0,
+                    "bytes_received": 0,
+                    "seconds": 0.0,
+                    "statuses": {},
+                    "histogram": [0] * len(self.buckets)
+                })
+            m["count"] += 1
+            m["bytes_sent"] += sent
+            m["bytes_received"] += received
+            m["seconds"] += seconds
+            m["statuses"][str(status)] = m["statuses"].get(str(status), 0) + 1
+            m["histogram"][bisect.bisect_left(self.buckets, seconds)] += 1
+
+        return
+
+    def requests(self):
+        with self.lock:
+            return sum([m["count"] for m in self.ops.values()])
+
+    def quantile(self, histogram, q):
+        # linear interpolation inside the bucket, like histogram_quantile of prometheus
+        rank = q * sum(histogram)
+        total = 0
+        for i, count in enumerate(histogram):
+            if count and total + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) - 1 else lower
+                return lower + (upper - lower) * (rank - total) / count
+            total += count
+
+        return 0.0
+
+    def summary(self):
+        with self.lock:
+            ops = {op: dict(m, statuses=dict(m["statuses"]), histogram=list(m["histogram"])) for op, m in self.ops.items()}
+
+        for m in ops.values():
+            for q in [50, 95, 99]:
+                m[f"p{q}"] = round(self.quantile(m["histogram"], q / 100), 4)
+
+        return {"target": self.target, "elapsed": round(time.monotonic() - self.started, 3), "ops": ops}
+
+    def prometheus(self, summary):
+        lines = [
+            "# HELP user_creation_requests_total HTTP requests sent to AEM.",
+            "# TYPE user_creation_requests_total counter"
+        ]
+        for op, m in summary["ops"].items():
+            for status, count in m["statuses"].items():
+                lines.append(f'user_creation_requests_total{{target="{self.target}",op="{op}",status="{status}"}} {count}')
+
+        lines += ["# HELP user_creation_bytes_total Bytes sent to and received from AEM.", "# TYPE user_creation_bytes_total counter"]
+        for op, m in summary["ops"].items():
+            lines.append(f'user_creation_bytes_total{{target="{self.target}",op="{op}",direction="sent"}} {m["bytes_sent"]}')
+            lines.append(f'user_creation_bytes_total{{target="{self.target}",op="{op}",direction="received"}} {m["bytes_received"]}')
+
+        lines += ["# HELP user_creation_request_duration_seconds Latency of requests to AEM.", "# TYPE user_creation_request_duration_seconds histogram"]
+        for op, m in summary["ops"].items():
+            total = 0
+            for bound, count in zip(self.buckets, m["histogram"]):
+                total += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(f'user_creation_request_duration_seconds_bucket{{target="{self.target}",op="{op}",le="{le}"}} {total}')
+            lines.append(f'user_creation_request_duration_seconds_sum{{target="{self.target}",op="{op}"}} {m["seconds"]:.6f}')
+            lines.append(f'user_creation_request_duration_seconds_count{{target="{self.target}",op="{op}"}} {m["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        summary = self.summary()
+        for op, m in sorted(summary["ops"].items()):
+            statuses = ", ".join([f"{status}: {count}" for status, count in sorted(m["statuses"].items())])
+            log.info(f"{op}: {m['count']} requests, p50: {m['p50']:.3f}s, p95: {m['p95']:.3f}s, p99: {m['p99']:.3f}s, {statuses}")
+
+        # compare also reads environments which weren't given by --target
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "metrics.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
+
+        # node_exporter reads *.prom files of its textfile directory, so the file is replaced atomically
+        path = os.path.join(directory, "metrics.prom")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus(summary))
+        os.replace(path + ".tmp", path)
+
+        return
+
+class Progress:
+
+    # a throughput and ETA line is logged every interval seconds while rows are processed
+    def __init__(self, target, total, metrics, interval=5):
+        self.target = target
+        self.total = total
+        self.metrics = metrics
+        self.interval = interval
+        self.done = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        return
+
+    def __enter__(self):
+        if self.interval and self.total:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+
+    def advance(self, n=1):
+        with self.lock:
+            self.done += n
+
+        return
+
+    def wrap(self, func):
+        def step(item):
+            ret = func(item)
+            self.advance()
+            return ret
+
+        return step
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            elapsed = time.monotonic() - self.started
+            rate = self.done / elapsed
+            eta = (self.total - self.done) / rate if rate else float("inf")
+            log.info(
+                    f"{self.target}: {self.done}/{self.total} rows, {rate:.1f} rows/s, "
+                    f"{self.metrics.requests() / elapsed:.1f} requests/s, ETA {eta:.0f}s"
+                )
+
+        return
+
 class UserMigration:
 
     domain = "http://localhost:4502"
@@ -100,88 +609,215 @@ class UserMigration:
     api_password = "admin"
     dryrun = True
 
+    # default settings of the pooled keep-alive session
+    session_defaults = {
+        "pool_size": 10,
+        "connect_timeout": 5,
+        "read_timeout": 60
+    }
+
     def __init__(self, opt):
+        import requests
+
         self.domain = opt["url"]
         self.api_user = opt["user"]
         self.api_password = opt["password"]
         self.dryrun = opt["dryrun"]
+        self.workers = opt.get("workers", 1)
+        self.batch = opt.get("batch", {})
+        self.page_size = opt.get("page_size", 1000)
+        self.user_ids = None
+        self.groups = None
+        self.groups_with_members = False
+        self.users = None
+        self.lock = threading.Lock()
+
+        # one keep-alive session per environment, so that tcp/tls connections are reused
+        session_opt = deepmerge(self.session_defaults, opt.get("session", {}))
+        self.timeout = (session_opt["connect_timeout"], session_opt["read_timeout"])
+        self.adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=session_opt["pool_size"],
+                pool_block=True
+            )
+        self.session = requests.Session()
+        self.session.auth = (self.api_user, self.api_password)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.rate = RateController(opt.get("rate", {}))
+        self.retry = RetryPolicy(opt.get("retry", {}))
+        self.metrics = Metrics(opt.get("name", self.domain))
 
         return
 
-    def query_builder(self, criteria):
+    def request(self, method, uri, **kwargs):
+        import requests
+
+        kwargs.setdefault("timeout", self.timeout)
+
+        op = operation(method, uri, kwargs.get("params"), kwargs.get("data"))
+        attempt = 0
+        while True:
+            # every request passes the rate controller, which adapts to the load of the author
+            started = self.rate.acquire()
+            overloaded = True
+            retry_after = None
+            status = "error"
+            sent = received = 0
+            try:
+                r = self.session.request(method, f"{self.domain}{uri}", **kwargs)
+                overloaded = r.status_code in [429, 503]
+                status, sent, received = r.status_code, len(r.request.body or ""), len(r.content)
+                r.attempts = attempt + 1
+                if not r.status_code in self.retry.statuses or not self.retry.allow(attempt):
+                    return r
+                retry_after = r.headers.get("Retry-After")
+                reason = r.status_code
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if not self.retry.allow(attempt):
+                    raise
+                reason = type(err).__name__
+            finally:
+                self.rate.release(started, overloaded)
+                self.metrics.record(op, status, time.monotonic() - started, sent, received)
+
+            delay = self.retry.delay(attempt, retry_after)
+            attempt += 1
+            log.warning(f"{method} {uri} failed ({reason}), retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def connection_stats(self):
+        stats = {"requests": 0, "connections": 0}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+        stats["reused"] = stats["requests"] - stats["connections"]
+
+        return stats
+
+    def close(self):
+        self.session.close()
+
+    @phase("lookups")
+    def query_builder(self, criteria, properties=None):
         api_uri = "/bin/querybuilder.json"
-        params = deepmerge({"p.hits": "full", "p.limit": "-1"}, criteria)
+        params = hit_params(criteria, properties)
 
-        auth = (self.api_user, self.api_password)
         try:
-            r = requests.get(f"{self.domain}{api_uri}", params=params, auth=auth)
+            r = self.request("GET", api_uri, params=params)
 
+            # an empty result of a failed query would look like missing users or groups
             if not r.status_code == 200:
-                return {}
+                raise UserMigrationError(f"querybuilder request failed: {r.status_code}")
             return r.json()["hits"]
-        except: 
-            raise UserMigration('Except error was happend when requesting a query builder request')
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when requesting a query builder request') from err
+
+    def iter_query(self, criteria, page_size=None, properties=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # hits are fetched page by page with p.offset, and the next page is requested
+        # while the caller handles the current one, so at most two pages are held in memory
+        page_size = page_size or self.page_size
+
+        def fetch(offset):
+            return self.query_builder(deepmerge(criteria, {
+                    "p.offset": str(offset),
+                    "p.limit": str(page_size),
+                    "p.guessTotal": "true"
+                }), properties)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            offset = 0
+            future = executor.submit(fetch, offset)
+            while True:
+                hits = future.result()
+                if len(hits) == page_size:
+                    future = executor.submit(fetch, offset + page_size)
+
+                for hit in hits:
+                    yield hit
+
+                if len(hits) < page_size:
+                    break
+                offset += page_size
 
-    def query_node(self, node_path):
+        return
+
+    @phase("lookups")
+    def query_node(self, node_path, depth=10):
         if not node_path.endswith(".json"):
-            node_path = f"{node_path}.10.json"
+            node_path = f"{node_path}.{depth}.json"
  
-        auth = (self.api_user, self.api_password)
         try:
-            r = requests.get(f"{self.domain}{node_path}", auth=auth)
+            r = self.request("GET", node_path)
 
             if not r.status_code == 200:
                 return {}
             return r.json()
-        except: 
-            raise UserMigration('Except error was happend when requesting a query json of node')
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when requesting a query json of node') from err
+
+    @phase("lookups")
+    def user_directory(self):
+        # all users are loaded with one query, used by bulk operations like export
+        with self.lock:
+            if self.users is None:
+                criteria = text2dict('''
+                        path=/home/users
+                        type=rep:User
+                    ''')
+
+                self.users = UserDirectory(self.iter_query(criteria, properties=UserDirectory.properties))
+                log.info(f"loaded {len(self.users)} users")
+
+        return self.users
+
+    @phase("lookups")
+    def group_directory(self, members=False):
+        # all groups are loaded with one query and looked up in memory afterwards,
+        # rep:members can be large, so that it is fetched only when members are needed
+        with self.lock:
+            if self.groups is None or (members and not self.groups_with_members):
+                criteria = text2dict('''
+                        path=/home/groups
+                        type=rep:Group
+                    ''')
+                properties = GroupDirectory.properties + (["rep:members"] if members else [])
+
+                self.groups = GroupDirectory(self.iter_query(criteria, properties=properties))
+                self.groups_with_members = members
+                log.info(f"loaded {len(self.groups)} groups")
+
+        return self.groups
+
+    def find_groups(self, key, value):
+        group = self.group_directory().get(value, key)
+
+        return [group] if group else []
 
     def get_groups_having_uuid(self, user_uuid):
-        criteria = text2dict(f'''
-                path=/home/groups
-                type=rep:Group
-                property=rep:members
-                property.value={user_uuid}
-            ''')
-        
-        return self.query_builder(criteria)
+        return self.group_directory(members=True).groups_having(user_uuid)
 
     def get_group_by_uuid(self, uuid):
-        criteria = text2dict(f'''
-                path=/home/groups
-                type=rep:Group
-                property=jcr:uuid
-                property.value={uuid}
-            ''')
-        
-        return self.query_builder(criteria)
+        return self.find_groups("jcr:uuid", uuid)
 
     def get_group_by_name(self, name):
-        criteria = text2dict(f'''
-                path=/home/groups
-                type=rep:Group
-                property=rep:authorizableId
-                property.value={name}
-            ''')
-        
-        return self.query_builder(criteria)
+        return self.find_groups("rep:authorizableId", name)
 
     def get_group_by_name2(self, name):
-        criteria = text2dict(f'''
-                path=/home/groups
-                type=rep:Group
-                property=rep:authorizableId
-                property.value={name}
-            ''')
-        
-        ret = self.query_builder(criteria)
+        ret = self.get_group_by_name(name)
 
-        return self.query_node(ret[0]["jcr:path"])
+        # the profile is a direct child of the group node
+        return self.query_node(ret[0]["jcr:path"], depth=1)
 
     def group_exists(self, name):       
         return len(self.get_group_by_name(name))
 
-    def get_user_by_uuid(self, uuid):
+    def get_user_by_uuid(self, uuid, properties=None):
         criteria = text2dict(f'''
                 path=/home/users
                 type=rep:User
@@ -189,9 +825,9 @@ class UserMigration:
                 property.value={uuid}
             ''')
         
-        return self.query_builder(criteria)
+        return self.query_builder(criteria, properties)
 
-    def get_user_by_name(self, name):
+    def get_user_by_name(self, name, properties=None):
         criteria = text2dict(f'''
                 path=/home/users
                 type=rep:User
@@ -199,29 +835,86 @@ class UserMigration:
                 property.value={name}
             ''')
         
-        return self.query_builder(criteria)
+        return self.query_builder(criteria, properties)
 
     def user_exists(self, name):
+        if self.user_ids is not None:
+            return int(name in self.user_ids)
 
-        return len(self.get_user_by_name(name))
+        return len(self.get_user_by_name(name, ["jcr:path"]))
 
+    @phase("writes")
     def add_user_to_group(self, user_name, group_name):
 
-        auth = (self.api_user, self.api_password)
         try:
             group = self.get_group_by_name(group_name)[0]
             api_uri = group['jcr:path'] + ".rw.html"
             payload = {"addMembers": user_name}
 
-            r = requests.post(f"{self.domain}{api_uri}", data=payload, auth=auth)
+            r = self.request("POST", api_uri, data=payload)
             if r.status_code == 200:
                 log.info(f"Added {user_name} to {group_name} successfully")
+            elif self.is_member(user_name, group, group_name):
+                # a replayed add of an existing member is a success
+                log.info(f"{user_name} is already a member of {group_name}")
+                return 200
             else:
                 log.warning(f"Failed to add {user_name} to {group_name}")
 
             return r.status_code
-        except: 
-            raise UserMigration('Except error was happend when adding a user to a group')
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when adding a user to a group') from err
+
+    def is_member(self, user_name, group, group_name=None):
+        users = self.get_user_by_name(user_name, ["jcr:uuid"])
+        if not users:
+            return False
+
+        criteria = text2dict(f'''
+                path={group['jcr:path']}
+                path.self=true
+                type=rep:Group
+                property=rep:members
+                property.value={users[0]["jcr:uuid"]}
+            ''')
+
+        return len(self.query_builder(criteria, ["jcr:path"])) > 0
+
+    @phase("writes")
+    def add_users_to_group(self, user_name_list, group_name):
+        # the group endpoint accepts repeated addMembers parameters
+        try:
+            group = self.get_group_by_name(group_name)[0]
+            api_uri = group['jcr:path'] + ".rw.html"
+            payload = [("addMembers", user_name) for user_name in user_name_list]
+
+            r = self.request("POST", api_uri, data=payload)
+            if r.status_code == 200:
+                log.info(f"Added {len(user_name_list)} users to {group_name} successfully")
+            else:
+                log.warning(f"Failed to add {len(user_name_list)} users to {group_name}")
+
+            return r.status_code
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when adding users to a group') from err
+
+    @phase("writes")
+    def update_members(self, group_name, add_list=(), remove_list=()):
+        # members are added and removed in one request, the endpoint accepts both parameters
+        try:
+            group = self.get_group_by_name(group_name)[0]
+            api_uri = group['jcr:path'] + ".rw.html"
+            payload = [("addMembers", user_name) for user_name in add_list] + [("removeMembers", user_name) for user_name in remove_list]
+
+            r = self.request("POST", api_uri, data=payload)
+            if r.status_code == 200:
+                log.info(f"Added {len(add_list)} and removed {len(remove_list)} members of {group_name} successfully")
+            else:
+                log.warning(f"Failed to add {len(add_list)} and remove {len(remove_list)} members of {group_name}")
+
+            return r.status_code
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when updating members of a group') from err
 
     def add_user_to_groups(self, user_name, group_name_list):
         try:
@@ -232,76 +925,716 @@ class UserMigration:
                     all_groups_exist = False
 
             if all_groups_exist:
-                for group_name in group_name_list:
-                    self.add_user_to_group(user_name, group_name)
+                return [self.add_user_to_group(user_name, group_name) for group_name in group_name_list]
             else:
                 log.warning("Some groups were not found. So, skipped to add this user to any groups.")
+                return None
+
+        except Exception as err:
+            raise UserMigrationError('Except error was happend when adding a user to a group') from err
+
+    @phase("writes")
+    def create_user(self, user_info):
+        api_uri = "/libs/granite/security/post/authorizables"
+
+        payload = deepmerge({
+                "createUser": "",
+                "authorizableId": "",
+                "rep:password": "",
+                "profile/email": "",
+                "profile/familyName": "",
+                "profile/givenName": ""
+            }, user_info)
+
+        try:
+            if not self.user_exists(user_info["authorizableId"]):
+                r = self.request("POST", api_uri, data=payload)
+                status = r.status_code
+
+                # when the create was replayed, the first attempt may have created the user already
+                if not status == 201 and len(self.get_user_by_name(user_info["authorizableId"], ["jcr:path"])):
+                    status = 201 if r.attempts > 1 else 401
+
+                if status == 201:
+                    if self.user_ids is not None:
+                        self.user_ids.add(user_info["authorizableId"])
+                    log.info("Created user successfully: " + user_info["authorizableId"])
+                elif status == 401:
+                    log.warning(user_info["authorizableId"] + " has already existed. skip to create this user.")
+                else:
+                    log.warning("Failed to create user: " + user_info["authorizableId"])
+
+                return status
+            else:
+                log.warning(user_info["authorizableId"] + " has already existed. skip to create this user.")
+                return 401
+        except Exception as err: 
+            raise UserMigrationError('Except error was happend when creating a new user') from err
+
+class AsyncUserMigration:
+
+    domain = "http://localhost:4502"
+    api_user = "admin"
+    api_password = "admin"
+    dryrun = True
+
+    def __init__(self, opt):
+        self.domain = opt["url"]
+        self.api_user = opt["user"]
+        self.api_password = opt["password"]
+        self.dryrun = opt["dryrun"]
+        self.concurrency = opt.get("concurrency", 100)
+        self.retry = RetryPolicy(opt.get("retry", {}))
+        self.page_size = opt.get("page_size", 1000)
+        self.user_ids = None
+        self.session_opt = deepmerge(UserMigration.session_defaults, opt.get("session", {}))
+        self.groups = None
+        self.groups_with_members = False
+        self.users = None
+        self.stats = {"requests": 0, "connections": 0}
+        self.metrics = Metrics(opt.get("name", self.domain))
+
+        return
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        import asyncio
+
+        try:
+            import aiohttp
+        except ImportError:
+            raise UserMigrationError("aiohttp is required to use the asyncio client")
+
+        # count requests and opened connections like the pooled session of UserMigration
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.on_request_start)
+        trace.on_connection_create_end.append(self.on_connection_create_end)
+
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.users_lock = asyncio.Lock()
+        self.groups_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.api_user, self.api_password),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.session_opt["connect_timeout"],
+                    sock_read=self.session_opt["read_timeout"]
+                ),
+                trace_configs=[trace]
+            )
+
+        return
+
+    async def close(self):
+        await self.session.close()
+
+    async def on_request_start(self, session, context, params):
+        self.stats["requests"] += 1
+
+    async def on_connection_create_end(self, session, context, params):
+        self.stats["connections"] += 1
+
+    def connection_stats(self):
+        return deepmerge(self.stats, {"reused": self.stats["requests"] - self.stats["connections"]})
+
+    async def request(self, method, uri, **kwargs):
+        status, body, attempts = await self.send(method, uri, **kwargs)
+        return status, body
+
+    async def send(self, method, uri, **kwargs):
+        import asyncio
+        import aiohttp
+
+        op = operation(method, uri, kwargs.get("params"), kwargs.get("data"))
+        sent = len(urllib.parse.urlencode(kwargs.get("data") or {}, doseq=True))
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                # the semaphore caps the number of in-flight requests of this environment
+                async with self.semaphore:
+                    started = time.monotonic()
+                    try:
+                        async with self.session.request(method, f"{self.domain}{uri}", **kwargs) as r:
+                            body = await r.read()
+                            self.metrics.record(op, r.status, time.monotonic() - started, sent, len(body))
+                            if not r.status in self.retry.statuses or not self.retry.allow(attempt):
+                                if "json" in r.content_type:
+                                    return r.status, json.loads(body), attempt + 1
+                                return r.status, body.decode(r.charset or "utf-8"), attempt + 1
+                            retry_after = r.headers.get("Retry-After")
+                            reason = r.status
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                        self.metrics.record(op, "error", time.monotonic() - started, sent)
+                        raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                if not self.retry.allow(attempt):
+                    raise UserMigrationError(f"{method} {uri} failed") from err
+                reason = type(err).__name__
+
+            delay = self.retry.delay(attempt, retry_after)
+            attempt += 1
+            log.warning(f"{method} {uri} failed ({reason}), retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def query_builder(self, criteria, properties=None):
+        api_uri = "/bin/querybuilder.json"
+        params = hit_params(criteria, properties)
+
+        status, body = await self.request("GET", api_uri, params=params)
+        if not status == 200:
+            raise UserMigrationError(f"querybuilder request failed: {status}")
+        return body["hits"]
+
+    async def iter_query(self, criteria, page_size=None, properties=None):
+        import asyncio
+
+        page_size = page_size or self.page_size
+
+        def fetch(offset):
+            return asyncio.ensure_future(self.query_builder(deepmerge(criteria, {
+                    "p.offset": str(offset),
+                    "p.limit": str(page_size),
+                    "p.guessTotal": "true"
+                }), properties))
+
+        offset = 0
+        task = fetch(offset)
+        while True:
+            hits = await task
+            if len(hits) == page_size:
+                task = fetch(offset + page_size)
+
+            for hit in hits:
+                yield hit
+
+            if len(hits) < page_size:
+                break
+            offset += page_size
+
+    async def query_node(self, node_path, depth=10):
+        if not node_path.endswith(".json"):
+            node_path = f"{node_path}.{depth}.json"
+
+        status, body = await self.request("GET", node_path)
+        if not status == 200:
+            return {}
+        return body
+
+    async def user_directory(self):
+        async with self.users_lock:
+            if self.users is None:
+                criteria = text2dict('''
+                        path=/home/users
+                        type=rep:User
+                    ''')
+
+                self.users = UserDirectory([hit async for hit in self.iter_query(criteria, properties=UserDirectory.properties)])
+                log.info(f"loaded {len(self.users)} users")
+
+        return self.users
+
+    async def group_directory(self, members=False):
+        async with self.groups_lock:
+            if self.groups is None or (members and not self.groups_with_members):
+                criteria = text2dict('''
+                        path=/home/groups
+                        type=rep:Group
+                    ''')
+                properties = GroupDirectory.properties + (["rep:members"] if members else [])
+
+                self.groups = GroupDirectory([hit async for hit in self.iter_query(criteria, properties=properties)])
+                self.groups_with_members = members
+                log.info(f"loaded {len(self.groups)} groups")
+
+        return self.groups
+
+    async def find_groups(self, key, value):
+        group = (await self.group_directory()).get(value, key)
+
+        return [group] if group else []
+
+    async def get_groups_having_uuid(self, user_uuid):
+        return (await self.group_directory(members=True)).groups_having(user_uuid)
+
+    async def get_group_by_uuid(self, uuid):
+        return await self.find_groups("jcr:uuid", uuid)
+
+    async def get_group_by_name(self, name):
+        return await self.find_groups("rep:authorizableId", name)
+
+    async def get_group_by_name2(self, name):
+        ret = await self.get_group_by_name(name)
+
+        return await self.query_node(ret[0]["jcr:path"], depth=1)
+
+    async def group_exists(self, name):
+        return len(await self.get_group_by_name(name))
+
+    async def get_user_by_uuid(self, uuid, properties=None):
+        criteria = text2dict(f'''
+                path=/home/users
+                type=rep:User
+                property=jcr:uuid
+                property.value={uuid}
+            ''')
+
+        return await self.query_builder(criteria, properties)
+
+    async def get_user_by_name(self, name, properties=None):
+        criteria = text2dict(f'''
+                path=/home/users
+                type=rep:User
+                property=rep:authorizableId
+                property.value={name}
+            ''')
+
+        return await self.query_builder(criteria, properties)
+
+    async def user_exists(self, name):
+        if self.user_ids is not None:
+            return int(name in self.user_ids)
+
+        return len(await self.get_user_by_name(name, ["jcr:path"]))
+
+    async def add_user_to_group(self, user_name, group_name):
+        group = (await self.get_group_by_name(group_name))[0]
+        api_uri = group['jcr:path'] + ".rw.html"
+        payload = {"addMembers": user_name}
+
+        status, body = await self.request("POST", api_uri, data=payload)
+        if status == 200:
+            log.info(f"Added {user_name} to {group_name} successfully")
+        elif await self.is_member(user_name, group):
+            log.info(f"{user_name} is already a member of {group_name}")
+            return 200
+        else:
+            log.warning(f"Failed to add {user_name} to {group_name}")
+
+        return status
+
+    async def is_member(self, user_name, group):
+        users = await self.get_user_by_name(user_name, ["jcr:uuid"])
+        if not users:
+            return False
+
+        criteria = text2dict(f'''
+                path={group['jcr:path']}
+                path.self=true
+                type=rep:Group
+                property=rep:members
+                property.value={users[0]["jcr:uuid"]}
+            ''')
+
+        return len(await self.query_builder(criteria, ["jcr:path"])) > 0
+
+    async def add_user_to_groups(self, user_name, group_name_list):
+        import asyncio
+
+        all_groups_exist = True
+        for group_name in group_name_list:
+            if not await self.group_exists(group_name):
+                log.warning(f"{group_name} doesn't exist")
+                all_groups_exist = False
+
+        if all_groups_exist:
+            return list(await asyncio.gather(*[self.add_user_to_group(user_name, group_name) for group_name in group_name_list]))
+        else:
+            log.warning("Some groups were not found. So, skipped to add this user to any groups.")
+            return None
+
+    async def create_user(self, user_info):
+        api_uri = "/libs/granite/security/post/authorizables"
+
+        payload = deepmerge({
+                "createUser": "",
+                "authorizableId": "",
+                "rep:password": "",
+                "profile/email": "",
+                "profile/familyName": "",
+                "profile/givenName": ""
+            }, user_info)
+
+        if not await self.user_exists(user_info["authorizableId"]):
+            status, body, attempts = await self.send("POST", api_uri, data=payload)
+
+            # when the create was replayed, the first attempt may have created the user already
+            if not status == 201 and len(await self.get_user_by_name(user_info["authorizableId"], ["jcr:path"])):
+                status = 201 if attempts > 1 else 401
+
+            if status == 201:
+                if self.user_ids is not None:
+                    self.user_ids.add(user_info["authorizableId"])
+                log.info("Created user successfully: " + user_info["authorizableId"])
+            elif status == 401:
+                log.warning(user_info["authorizableId"] + " has already existed. skip to create this user.")
+            else:
+                log.warning("Failed to create user: " + user_info["authorizableId"])
+
+            return status
+        else:
+            log.warning(user_info["authorizableId"] + " has already existed. skip to create this user.")
+            return 401
+
+
+def target_list(config):
+    # --target accepts several environments separated by comma
+    return [target for target in str(config["target"]).split(",") if target]
+
+def initalize(config):
+    subdir = config["work_dir"]
+
+    if not os.path.exists(subdir): 
+        os.mkdir(subdir)
+
+    for target in target_list(config):
+        env_directory = str(pathlib.Path(f"./{subdir}/{target}"))
+        if os.path.exists(env_directory): 
+            shutil.rmtree(env_directory)
+        if not os.path.exists(env_directory): 
+            os.mkdir(env_directory)
+
+
+    return
+
+class Journal:
+
+    # append-only record of created users and added memberships, used by --resume
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.created = set()
+        self.added = set()
+
+        if resume and os.path.exists(path):
+            self.load()
+            self.compact()
+            log.info(f"resume from {path}: {len(self.created)} users, {len(self.added)} memberships")
+
+        # an import without --resume starts a new journal
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+
+        return
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be cut off when the previous run died
+                    continue
+
+                if entry["op"] == "create":
+                    self.created.add(entry["user"])
+                elif entry["op"] == "add":
+                    self.added.add((entry["user"], entry["group"]))
+
+        return
+
+    def compact(self):
+        # rewrite the journal with one entry per user and membership
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for user in sorted(self.created):
+                f.write(json.dumps({"op": "create", "user": user}) + "\n")
+            for user, group in sorted(self.added):
+                f.write(json.dumps({"op": "add", "user": user, "group": group}) + "\n")
+        os.replace(tmp, self.path)
+
+        return
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+        return
+
+    def record_create(self, user):
+        self.created.add(user)
+        self.write({"op": "create", "user": user})
+
+        return
+
+    def record_add(self, user, group):
+        self.added.add((user, group))
+        self.write({"op": "add", "user": user, "group": group})
+
+        return
+
+    def is_created(self, user):
+        return user in self.created
+
+    def is_added(self, user, group):
+        return (user, group) in self.added
+
+    def close(self):
+        self.file.close()
+
+def iso_date(value):
+    # jcr dates are rendered either as ISO 8601 or as ECMA script dates like "Wed Nov 04 2009 15:02:11 GMT+0100"
+    try:
+        date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            date = datetime.strptime(value, "%a %b %d %Y %H:%M:%S GMT%z")
+        except ValueError:
+            return None
+
+    return date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+class Snapshot:
+
+    # users, groups and memberships of an environment in one sqlite file
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+                create table if not exists authorizables (
+                    path text primary key, type text, id text, principal text, uuid text, name text, modified text
+                );
+                create index if not exists authorizables_id on authorizables (id);
+                create index if not exists authorizables_uuid on authorizables (uuid);
+                create table if not exists members (group_path text, member text);
+                create index if not exists members_group on members (group_path);
+                create index if not exists members_member on members (member);
+                create table if not exists meta (key text primary key, value text);
+            ''')
+
+        return
+
+    # properties which are fetched to refresh the snapshot
+    properties = AuthorizableDirectory.keys + ["jcr:primaryType", "jcr:lastModified", "profile/givenName", "rep:members"]
+
+    def high_water(self):
+        row = self.db.execute("select value from meta where key = 'modified'").fetchone()
+
+        return row[0] if row else None
+
+    def update(self, hits):
+        # hits replace the stored authorizables, and rep:members of updated groups replace their members
+        high_water = self.high_water()
+        count = 0
+        for hit in hits:
+            modified = iso_date(hit.get("jcr:lastModified", "")) if hit.get("jcr:lastModified") else None
+            self.db.execute(
+                    "insert or replace into authorizables values (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        hit["jcr:path"], hit.get("jcr:primaryType"), hit.get("rep:authorizableId"),
+                        hit.get("rep:principalName"), hit.get("jcr:uuid"),
+                        given_name(hit), modified
+                    )
+                )
+
+            if hit.get("jcr:primaryType") == "rep:Group":
+                members = hit.get("rep:members", [])
+                if isinstance(members, str):
+                    members = [members]
+                self.db.execute("delete from members where group_path = ?", (hit["jcr:path"],))
+                self.db.executemany("insert into members values (?, ?)", [(hit["jcr:path"], member) for member in members])
+
+            if modified is not None and (high_water is None or modified > high_water):
+                high_water = modified
+            count += 1
+
+        if high_water is not None:
+            self.db.execute("insert or replace into meta values ('modified', ?)", (high_water,))
+        self.db.commit()
+
+        return count
+
+    def hits(self, type):
+        # authorizables are returned in the shape of querybuilder hits, so that directories can be built offline
+        for path, id, principal, uuid, name in self.db.execute(
+                "select path, id, principal, uuid, name from authorizables where type = ?", (type,)):
+            hit = {
+                "jcr:path": path,
+                "jcr:primaryType": type,
+                "rep:authorizableId": id,
+                "rep:principalName": principal,
+                "jcr:uuid": uuid
+            }
+            if name is not None:
+                hit["profile"] = {"givenName": name}
+            if type == "rep:Group":
+                hit["rep:members"] = [row[0] for row in self.db.execute("select member from members where group_path = ?", (path,))]
+
+            yield hit
+
+        return
+
+    def user_directory(self):
+        return UserDirectory(self.hits("rep:User"))
+
+    def group_directory(self):
+        return GroupDirectory(self.hits("rep:Group"))
+
+    def close(self):
+        self.db.close()
+
+def snapshot_path(config, target, create=False):
+    # snapshots are kept outside of the target directory, which is cleared by each run
+    directory = pathlib.Path(f"./{config['work_dir']}/snapshots")
+    if create and not directory.exists():
+        directory.mkdir()
+
+    return str(directory / f"{target}.sqlite")
+
+def open_snapshot(config, target):
+    path = snapshot_path(config, target)
+    if not os.path.exists(path):
+        raise UserMigrationError(f"snapshot of {target} is not found: {path}")
+
+    return Snapshot(path)
+
+def refresh_snapshot(um, snapshot):
+    # only authorizables modified after the high-water mark are fetched, everything on the first run
+    high_water = snapshot.high_water()
+    for path, type in [("/home/users", "rep:User"), ("/home/groups", "rep:Group")]:
+        criteria = text2dict(f'''
+                path={path}
+                type={type}
+            ''')
+        if high_water is not None:
+            criteria = deepmerge(criteria, text2dict(f'''
+                    daterange.property=jcr:lastModified
+                    daterange.lowerBound={high_water}
+                    daterange.lowerOperation=>
+                '''))
+
+        count = snapshot.update(um.iter_query(criteria, properties=Snapshot.properties))
+        log.info(f"snapshot {snapshot.path}: {count} {type} updated")
+
+    return snapshot
+
+def load_directories(config, target, um=None):
+    # users and groups with members from one bulk read, from the snapshot or the environment
+    if config.get("offline"):
+        snapshot = open_snapshot(config, target)
+    elif config.get("snapshot"):
+        snapshot = refresh_snapshot(um, Snapshot(snapshot_path(config, target, create=True)))
+    else:
+        return um.user_directory(), um.group_directory(members=True)
 
-        except:
-            raise UserMigration('Except error was happend when adding a user to a group')               
+    users, groups = snapshot.user_directory(), snapshot.group_directory()
+    snapshot.close()
 
-    def create_user(self, user_info):
-        api_uri = "/libs/granite/security/post/authorizables"
+    return users, groups
 
-        payload = deepmerge({
-                "createUser": "",
-                "authorizableId": "",
-                "rep:password": "",
-                "profile/email": "",
-                "profile/familyName": "",
-                "profile/givenName": ""
-            }, user_info)
+def journal_path(config, target):
+    # journals are kept outside of the target directory, so that runs without --execute don't lose them
+    directory = pathlib.Path(f"./{config['work_dir']}/journals")
+    if not directory.exists():
+        directory.mkdir()
 
-        auth = (self.api_user, self.api_password)
-        try:
-            if not self.user_exists(user_info["authorizableId"]):
-                r = requests.post(f"{self.domain}{api_uri}", data=payload, auth=auth)
+    return str(directory / f"{target}.jsonl")
 
-                if r.status_code == 201:
-                    log.info("Created user successfully: " + user_info["authorizableId"])
-                else:
-                    log.warning("Failed to create user: " + user_info["authorizableId"])
+# compact record of a csv row, columns which the mode doesn't need are left as None
+# usernames holds the username of every target when several targets are read
+UserRecord = namedtuple("UserRecord", ["line", "username", "givenName", "familyName", "email", "groups", "password", "usernames"])
+UserRecord.__new__.__defaults__ = (None,) * 6
 
-                return r.status_code
-            else:
-                log.warning(user_info["authorizableId"] + " has already existed. skip to create this user.")
-                return 401
-        except: 
-            raise UserMigration('Except error was happend when creating a new user')
+class UserlistReader:
 
+    # columns which each mode needs besides the username column of the target
+    columns = {
+        "import": ["givenName", "familyName", "email", "groups", "password"],
+        "reconcile": ["givenName", "familyName", "email", "groups", "password"],
+        "package": ["givenName", "familyName", "email", "groups", "password"],
+        "export": [],
+        "compare": []
+    }
 
+    def __init__(self, path, target, mode):
+        self.path = path
+        self.targets = target if isinstance(target, list) else [target]
+        self.fields = self.columns.get(mode, [])
+        self.rows = 0
+        self.errors = 0
+        self.passes = 0
 
+        if not os.path.isfile(path):
+            raise UserMigrationError(f'{path} is not found')
 
-def initalize():
-    subdir = config["work_dir"]
-    env_directory = str(pathlib.Path(f"./{subdir}/" + config["target"]))   
+        return
 
-    if not os.path.exists(subdir): 
-        os.mkdir(subdir)
-    if os.path.exists(env_directory): 
-        shutil.rmtree(env_directory)
-    if not os.path.exists(env_directory): 
-        os.mkdir(env_directory)
+    def __iter__(self):
+        # rows are parsed lazily, so that requests can be sent while the csv is still being read
+        records = self.parse()
+        while True:
+            with phases.measure("csv parse"):
+                user = next(records, None)
+            if user is None:
+                break
+            yield user
 
+        return
 
-    return
+    def parse(self):
+        # the counters are of the last pass, and bad rows are only warned on the first pass
+        self.rows = 0
+        self.errors = 0
+        self.passes += 1
 
-def read_userlist(path):
-    try:
-        with open(path, 'r',encoding="utf-8_sig") as f:
+        with open(self.path, 'r', encoding="utf-8_sig", newline="") as f:
             reader = csv.reader(f, dialect='excel')
-            header = []
-            userlist = []
-            for row in reader:
-                if len(header) == 0:
-                    header = row
-                else:
-                    userlist.append({key: val for key, val in zip(header, row)})
-    except:
-        log.critical(f'Unexpected error happen while reading {path}')
-        sys.exit(1)
+            header = next(reader, [])
+            missing = [column for column in self.targets + self.fields if column not in header]
+            if missing:
+                raise UserMigrationError(f"{self.path} doesn't have columns: " + ", ".join(missing))
+
+            username_indexes = [header.index(target) for target in self.targets]
+            indexes = [header.index(field) if field in self.fields else None for field in UserRecord._fields[2:7]]
+
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as err:
+                    self.error(reader.line_num, err)
+                    continue
+
+                if not row:
+                    continue
+                if not len(row) == len(header):
+                    self.error(reader.line_num, f"expected {len(header)} columns, but got {len(row)}")
+                    continue
+                usernames = tuple([row[index] for index in username_indexes])
+                if not all(usernames):
+                    self.error(reader.line_num, f"username of {', '.join(self.targets)} is empty")
+                    continue
+
+                self.rows += 1
+                yield UserRecord(
+                        reader.line_num,
+                        usernames[0],
+                        *[None if index is None else row[index] for index in indexes],
+                        usernames if len(usernames) > 1 else None
+                    )
+
+        if self.errors and self.passes == 1:
+            log.warning(f"{self.errors} rows of {self.path} were skipped")
 
-    return userlist
+        return
+
+    def error(self, line, message):
+        self.errors += 1
+        if self.passes == 1:
+            log.warning(f"{self.path}:{line}: {message}")
+
+        return
+
+phases.register("csv parse", UserlistReader.parse)
 
 def ok(evaluation, description):
     if evaluation:
@@ -311,821 +1644,1454 @@ def ok(evaluation, description):
 
     return
 
-def on_import(config):
-    target = config["target"]
-
-    # generage UserMigration object
+def migration_options(config, target):
     for env in config["environment"]:
         if env["name"] == target:
             log.info(f"target environment: {target}, " + env["url"])
             opt = {
+                "name": target,
                 "url": env["url"],
                 "user": env["user"],
                 "password": env["password"],
-                "dryrun": config["dryrun"]
+                "dryrun": config["dryrun"],
+                "workers": config.get("workers") or env.get("workers", 1),
+                "concurrency": env.get("concurrency", 100),
+                "page_size": env.get("page_size", config.get("page_size", 1000)),
+                "batch": deepmerge(MembershipBatcher.defaults, config.get("batch", {}), env.get("batch", {})),
+                "session": deepmerge(config.get("session", {}), env.get("session", {})),
+                "rate": deepmerge(config.get("rate", {}), env.get("rate", {})),
+                "retry": deepmerge(config.get("retry", {}), env.get("retry", {}))
             }
 
-    um = UserMigration(opt)
+            # every worker needs its own connection, up to the in-flight cap
+            pool_size = opt["session"].get("pool_size", UserMigration.session_defaults["pool_size"])
+            max_in_flight = opt["rate"].get("max_in_flight", RateController.defaults["max_in_flight"])
+            opt["session"]["pool_size"] = max(pool_size, min(opt["workers"], max_in_flight))
 
-    # read userlist and get username
-    userlist = read_userlist(config["userlist"])
+            return opt
 
-    # create user and add user to group
-    for user in userlist:
-        username = user[target]
-        user_info = {
-                "authorizableId": username,
-                "rep:password": user["password"],
-                "profile/email": user["email"],
-                "profile/familyName": user["familyName"],
-                "profile/givenName": user["givenName"]
-            }
+    raise UserMigrationError(f"{target} is not defined in environment")
 
-        ret = um.create_user(user_info)
-        if ret == 201:
-            groups = user["groups"].split('|')
-            um.add_user_to_groups(username,groups)
-        else:
-            groups = user["groups"].split('|')
-            um.add_user_to_groups(username,groups)
+def report_connections(um, config):
+    um.metrics.write(str(pathlib.Path(f"./{config['work_dir']}/{um.metrics.target}")))
+
+    stats = um.connection_stats()
+    log.info(f"http requests: {stats['requests']}, connections: {stats['connections']}, reused: {stats['reused']}")
+
+    if hasattr(um, "rate"):
+        rate = um.rate.report()
+        log.info(
+                f"in-flight limit: {rate['limit']} (peak {rate['peak']}), decreases: {rate['decreases']}, "
+                f"overloads: {rate['overloads']}, latency p50: {rate['p50']:.3f}s, p95: {rate['p95']:.3f}s"
+            )
 
     return
 
-def on_export(config):
-    target = config["target"]
+class ImportSummary:
 
-    # generage UserMigration object
-    for env in config["environment"]:
-        if env["name"] == target:
-            log.info(f"target environment: {target}, " + env["url"])
-            opt = {
-                "url": env["url"],
-                "user": env["user"],
-                "password": env["password"],
-                "dryrun": config["dryrun"]
-            }
+    keys = ["created", "existing", "unchanged", "resumed", "failed", "added", "add failed", "skipped", "invalid"]
 
-    um = UserMigration(opt)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
 
-    # read userlist and get username
-    userlist = read_userlist(config["userlist"])
+        return
 
-    # export group information
-    for user in userlist:
-        username = user[target]
-        groupname = []
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+        return
 
-        if um.user_exists(username):
-            u = um.get_user_by_name(username)
-            groups = um.get_groups_having_uuid(u[0]["jcr:uuid"])
-            for group in groups:
-                g = um.get_group_by_name2(group["rep:authorizableId"])
+    def report(self, target):
+        log.info(f"summary of {target}: " + ", ".join([f"{key}: {self.counts.get(key, 0)}" for key in self.keys]))
 
-                if "profile" in g:
-                    if "givenName" in g["profile"]:
-                        groupname.append(g["profile"]["givenName"])
-                    else: 
-                        groupname.append(g["rep:authorizableId"])
+        return
 
+def run_parallel(func, items, workers):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-#                print(um.get_group_by_name2(group["rep:authorizableId"]))
-#                groupname.append(group["rep:authorizableId"])
+    # keep at most twice as many tasks as workers in flight, so that items are consumed lazily
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
 
-        log.info(f"{username}," + "|".join(groupname)) 
+        for future in wait(pending).done:
+            future.result()
 
-#    def user_exists(self, name):
+    return
 
-#    def user_exists(self, name):
-#    def get_groups_having_uuid(self, user_uuid):
-#    def get_group_by_uuid(self, uuid):
+def chunked(items, size):
+    # size 0 means all items in one chunk
+    if not size:
+        yield items
+        return
 
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
 
+class MembershipBatcher:
 
-    sys.exit()
+    # size: members per request, chunk: csv rows collected before the members are sent (0 means all rows)
+    defaults = {"size": 500, "chunk": 0}
 
-    return
+    def __init__(self, um, summary, journal):
+        self.um = um
+        self.summary = summary
+        self.journal = journal
+        self.size = um.batch.get("size", self.defaults["size"])
+        self.lock = threading.Lock()
+        self.members = {}
 
-def on_compare(config):
-    log.debug("on compare")
-    return
+        return
 
-def main():
-    initalize()
+    def add(self, user_name, group_name_list):
+        all_groups_exist = True
+        for group_name in group_name_list:
+            if not self.um.group_exists(group_name):
+                log.warning(f"{group_name} doesn't exist")
+                all_groups_exist = False
 
-    event_hander = {"import": on_import, "export": on_export, "compare": on_compare}
-    for key in event_hander.keys():
-        if config["mode"] == key:
-            event_hander[config["mode"]](config)
+        if not all_groups_exist:
+            log.warning("Some groups were not found. So, skipped to add this user to any groups.")
+            return False
 
-    sys.exit()
-    global url, user, password
+        with self.lock:
+            for group_name in group_name_list:
+                self.members.setdefault(group_name, []).append(user_name)
 
-    url = "http://localhost:4502"
-    user = "admin"
-    password = "admin"
+        return True
 
+    def batches(self):
+        with self.lock:
+            members, self.members = self.members, {}
 
+        for group_name, user_name_list in members.items():
+            for i in range(0, len(user_name_list), self.size):
+                yield group_name, user_name_list[i:i + self.size]
 
-    if config["mode"] == "import":
-        url=config["destination"]["url"]
-        user=config["destination"]["user"]
-        password=config["destination"]["password"]
-        source_env = config["source"]["name"]
-        env = config["destination"]["name"]
+    def send(self, group_name, user_name_list):
+        try:
+            if self.um.add_users_to_group(user_name_list, group_name) == 200:
+                self.summary.count("added", len(user_name_list))
+                for user_name in user_name_list:
+                    self.journal.record_add(user_name, group_name)
+                return
+        except UserMigrationError as err:
+            # the environment is unreachable even after the retries, the import continues with the next batch
+            log.error(f"{group_name}: {err} ({err.__cause__ or 'no cause'})")
+            self.summary.count("add failed", len(user_name_list))
+            return
+
+        # the response doesn't tell which member failed, so the members are added one by one
+        for user_name in user_name_list:
+            try:
+                status = self.um.add_user_to_group(user_name, group_name)
+            except UserMigrationError as err:
+                log.error(f"{user_name}: {err} ({err.__cause__ or 'no cause'})")
+                status = None
+
+            if status == 200:
+                self.summary.count("added")
+                self.journal.record_add(user_name, group_name)
+            else:
+                self.summary.count("add failed")
 
+        return
 
-        # read userlist and get username
-        userlist = read_userlist(config["userlist"])
+    def flush(self, workers):
+        run_parallel(lambda batch: self.send(*batch), self.batches(), workers)
 
-        # .
-        for row in userlist:
-            username = row[source_env]
-            new_username = row[env]
+        return
 
-            input = str(pathlib.Path(f"./" + config["work_dir"] + f"/{source_env}/{username}.json"))
-            with open(input) as f:
-                group_info= json.load(f)
+def user_info_of(user):
+    return {
+            "authorizableId": user.username,
+            "rep:password": user.password,
+            "profile/email": user.email,
+            "profile/familyName": user.familyName,
+            "profile/givenName": user.givenName
+        }
 
-            # confirm all groups in json file exist
-            exist_all_group = True
-            for group in group_info:
-                if not get_group( group["rep:authorizableId"] ):
-                    log.warning( group["rep:authorizableId"] + " doesn't exist")
-                    exist_all_group = False
-                    break
-                
-            if not exist_all_group:
-                log.warning( "skip creating " + new_username)
-                break
+def oak_password_hash(password, algorithm="SHA-256", iterations=1000, salt_size=8, salt=None):
+    # the format of Oak's PasswordUtil, {algorithm}salt-iterations-hash with the salt and hash in hex,
+    # a random salt of salt_size bytes is drawn unless the hex salt is given
+    import hashlib
 
-            # create user
-            if 0 == create_user(new_username, row["password"], row["firstname"], row["lastname"], row["email"] ):
-                for group in group_info:
-                    # add user to group
-                    g = get_group( group["rep:authorizableId"] )                    
-                    add_user_to_group(new_username, g[0]["jcr:path"])
+    if salt is None:
+        salt = os.urandom(salt_size).hex()
+    if algorithm.startswith("PBKDF2"):
+        # e.g. PBKDF2WithHmacSHA512, Oak derives a 128 bit key from the salt bytes
+        digest = hashlib.pbkdf2_hmac(algorithm[len("PBKDF2WithHmac"):].lower(), password.encode("utf-8"), bytes.fromhex(salt), iterations, dklen=16)
+    else:
+        name = algorithm.replace("-", "").lower()
+        new = getattr(hashlib, name, None) or functools.partial(hashlib.new, name)
+        digest = (salt + password).encode("utf-8")
+        for i in range(iterations):
+            digest = new(digest).digest()
 
-            # query group list which user is belong to.
-            uuid = get_uuid_by_username(new_username)
-            group_list = get_groups_having_uuid(uuid)
-            log.debug(f"username: {new_username}, uuid: {uuid}, group_list: " + json.dumps(group_list))
-            if len(group_list) > 0:
-                output_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{env}"))
-                output = str(pathlib.Path(f"./" + f"{output_dir}/{new_username}.json"))
-                if not os.path.exists(output_dir): 
-                    os.mkdir(output_dir)
-                with open(output, 'w') as f:
-                    json.dump(group_list, f, indent=4)
+    if iterations > 1:
+        return f"{{{algorithm}}}{salt}-{iterations}-{digest.hex()}"
 
+    return f"{{{algorithm}}}{salt}-{digest.hex()}"
 
+def is_password_hash(password):
+    # a password of the csv which is hashed already is sent as it is
+    import re
 
+    return re.match(r"^\{[^}]+\}[0-9a-f]+-", password) is not None
 
+def hash_password(password, opt):
+    if not password or not opt or is_password_hash(password):
+        return password
 
+    return oak_password_hash(password, opt["algorithm"], opt["iterations"], opt["salt_size"])
 
+def hash_rows(users, opt):
+    # runs in a worker process
+    return [user._replace(password=hash_password(user.password, opt)) for user in users]
 
-    elif config["mode"] == "export":
+def password_hash_options(config):
+    # workers: processes which hash passwords, 0 means all cores
+    if not config.get("hash_passwords"):
+        return None
 
-        url=config["source"]["url"]
-        user=config["source"]["user"]
-        password=config["source"]["password"]
-        env = config["source"]["name"]
+    return deepmerge({"algorithm": "SHA-256", "iterations": 1000, "salt_size": 8, "workers": 0, "chunk": 100}, config.get("password_hash", {}))
 
-        # read userlist
-        userlist = read_userlist(config["userlist"])
+def hashed_rows(rows, opt):
+    # passwords are hashed in a process pool ahead of the writes, plaintext only lives in the chunks in flight
+    from concurrent.futures import ProcessPoolExecutor
 
-        # query group list which user is belong to.
-        for row in userlist:
-            username = row[env]
-            uuid = get_uuid_by_username(username)
-            group_list = get_groups_having_uuid(uuid)
-            log.debug(f"username: {username}, uuid: {uuid}, group_list: " + json.dumps(group_list))
-            if len(group_list) > 0:
-                output_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{env}"))
-                output = str(pathlib.Path(f"./" + f"{output_dir}/{username}.json"))
-                if not os.path.exists(output_dir): 
-                    os.mkdir(output_dir)
+    workers = opt["workers"] or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for users in ordered_results(executor, functools.partial(hash_rows, opt=opt), chunked(rows, opt["chunk"]), workers * 2):
+            for user in users:
+                yield user
 
-                with open(output, 'w') as f:
-                    json.dump(group_list, f, indent=4)
+    return
 
+def count_import(summary, username, ret, statuses=None):
+    if ret == 201:
+        summary.count("created")
+    elif ret == 401:
+        summary.count("existing")
     else:
-        source_env = config["source"]["name"]
-        destination_env = config["destination"]["name"]
-        source_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{source_env}"))
-        destination_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{destination_env}"))
+        summary.count("failed")
+        log.warning(f"skipped to add {username} to groups")
+        return
 
-        # read userlist and get username
-        userlist = read_userlist(config["userlist"])
+    if statuses is None:
+        summary.count("skipped")
+        return
 
-        # .
-        try:
-            for row in userlist:
-                source_username = row[source_env]
-                destination_username = row[destination_env]
+    added = len([status for status in statuses if status == 200])
+    summary.count("added", added)
+    summary.count("add failed", len(statuses) - added)
 
-                source_json = str(pathlib.Path(f"./{source_dir}/{source_username}.json"))
-                destination_json = str(pathlib.Path(f"./{destination_dir}/{destination_username}.json"))
+    return
 
-                with open(source_json) as f:
-                    _source_group= json.load(f)
-                    source_group = list(map(lambda x: x["rep:principalName"], _source_group))
-                    source_group.sort()
-                with open(destination_json) as f:
-                    _destination_group= json.load(f)
-                    destination_group = list(map(lambda x: x["rep:principalName"], _destination_group))
-                    destination_group.sort()
+def pending_groups(user, journal):
+    return [group_name for group_name in user.groups.split('|') if group_name and not journal.is_added(user.username, group_name)]
 
-                ok(source_group == destination_group, f"compare {source_username} with {destination_username}")
-                if not source_group == destination_group:
-                        log.warning("\n" + tabulate({source_env: source_group, destination_env: destination_group}, headers='keys'))
+def record_adds(journal, username, groups, statuses):
+    for group_name, status in zip(groups, statuses or []):
+        if status == 200:
+            journal.record_add(username, group_name)
 
+    return
 
-        except Exception as err:
-            log.error(f"Unexpected {err=}, {type(err)=}")
-            sys.exit(1)
-            
-    return 0
-
-main()
-
-
-
-
-
-opt = {
-    "url": "http://localhost:4502",
-    "user": "admin",
-    "password": "admin"
-}
-um = UserMigration(opt)
-# print(um.query_builder(text2dict(
-#     f'''
-#         path=/home/groupsasdf
-#         type=rep:Group
-#         property=rep:principalName
-#         property.value={groupname}
-#     '''
-# ))) 
-
-user_info = {
-        "authorizableId": "testuser",
-        "rep:password": "testuser",
-        "profile/email": "aa",
-        "profile/familyName": "bb",
-        "profile/givenName": "cc"
-    }
+def import_user(um, user, summary, journal, batcher=None):
+    try:
+        username = user.username
+        groups = pending_groups(user, journal)
 
-func = ok
-print(func(True, "desc"))
+        # rows completed by a previous run are skipped without any request
+        if journal.is_created(username) and not groups:
+            summary.count("resumed")
+            return
 
-ret = um.create_user(user_info)
-if ret == 201:
-    print(um.add_user_to_groups("testuser",["dam-users", "analytics-administrators", "af-template-script-writers"]))
+        # groups are added only after the user has been created or is known to exist
+        if journal.is_created(username):
+            ret = 401
+        else:
+            ret = um.create_user(user_info_of(user))
+            if ret not in [201, 401]:
+                return count_import(summary, username, ret)
+            journal.record_create(username)
+
+        if batcher is not None:
+            # memberships are counted when the batcher sends them
+            queued = batcher.add(username, groups)
+            return count_import(summary, username, ret, [] if queued else None)
+
+        statuses = um.add_user_to_groups(username, groups)
+        record_adds(journal, username, groups, statuses)
+
+        return count_import(summary, username, ret, statuses)
+    except UserMigrationError as err:
+        # a request which failed even after the retries fails only this user
+        summary.count("failed")
+        log.error(f"{user.username}: {err} ({err.__cause__ or 'no cause'})")
+
+async def async_import_user(um, user, summary, journal):
+    try:
+        username = user.username
+        groups = pending_groups(user, journal)
 
+        if journal.is_created(username) and not groups:
+            summary.count("resumed")
+            return
 
+        if journal.is_created(username):
+            ret = 401
+        else:
+            ret = await um.create_user(user_info_of(user))
+            if ret not in [201, 401]:
+                return count_import(summary, username, ret)
+            journal.record_create(username)
 
-sys.exit(0)
+        statuses = await um.add_user_to_groups(username, groups)
+        record_adds(journal, username, groups, statuses)
 
+        return count_import(summary, username, ret, statuses)
+    except UserMigrationError as err:
+        # a request which failed even after the retries fails only this user
+        summary.count("failed")
+        log.error(f"{user.username}: {err} ({err.__cause__ or 'no cause'})")
 
+async def run_async(func, items, concurrency):
+    import asyncio
 
-def read_userlist(path):
-    try:
-        with open(path, 'r',encoding="utf-8_sig") as f:
-            reader = csv.reader(f, dialect='excel')
-            header = []
-            userlist = []
-            for row in reader:
-                if len(header) == 0:
-                    header = row
-                else:
-                    userlist.append({key: val for key, val in zip(header, row)})
-    except:
-        log.critical(f'Unexpected error happen while reading {path}')
-        sys.exit(1)
+    # a fixed number of coroutines pull items, so that items are consumed lazily
+    items = iter(items)
 
-    return userlist
+    async def worker():
+        for item in items:
+            await func(item)
 
-def http_request(command):
-    try:
-        log.debug(f"curl commnad: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if not result.returncode == 0:
-            log.error(result.stderr)
-            raise ValueError("os command failed")
+    await asyncio.gather(*[worker() for i in range(concurrency)])
 
-        res = json.loads(result.stdout)
+    return
 
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
+async def async_import(config, target, rows, journal, plan, metrics):
+    async with AsyncUserMigration(migration_options(config, target)) as um:
+        summary = ImportSummary()
+        # the requests of the plan and of the import are reported together
+        um.metrics = metrics
+        um.users, um.groups, um.groups_with_members = plan.users, plan.groups, True
+        um.user_ids = set(plan.users.index["rep:authorizableId"])
 
-    return res
+        with Progress(target, len(plan.rows), metrics, config.get("progress_interval", 5)) as progress:
+            async def step(user):
+                await async_import_user(um, user, summary, journal)
+                progress.advance()
 
-def query_builder(criteria):
+            await run_async(step, rows, um.concurrency)
 
-    
-    params = {"path": "/home/groups", "type": "rep:Group"}
-    auth = (user, password)
-    r = requests.get(f"{url}/bin/querybuilder.json", params=params, auth=(user, password))
+        summary.count("unchanged", plan.unchanged)
+        summary.count("skipped", plan.skipped)
+        summary.count("invalid", plan.invalid)
+        summary.report(target)
+        report_connections(um, config)
 
-    print(r)
-    sys.exit(0)
+    return summary
 
-    command = f"curl -k -sS -u {user}:{password} {url}/bin/querybuilder.json"
-    for c in criteria:
-        command += f" --data-urlencode \"{c}\""
+async def async_export(config, target, usernames):
+    import asyncio
 
-    try:
-        res = http_request(command)
-        if not res["success"] == True:
-            log.error("http_request failed")
-            log.info(f"res: {res}")
-            raise ValueError("os command failed")
-
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
-        
-    return res["hits"]
+    async with AsyncUserMigration(migration_options(config, target)) as um:
+        # users and groups are fetched concurrently
+        users, groups = await asyncio.gather(um.user_directory(), um.group_directory(members=True))
+        write_export(config, target, users, groups, usernames)
 
+        report_connections(um, config)
 
-def text2list(criteria):
-    return criteria.replace(" ", "").replace('"', '\\"').split("\n")
+    return
 
-def get_groups_having_uuid(user_uuid):
-    criteria = f'''
-        path=/home/groups
-        type=rep:Group
-        property=rep:members
-        property.value={user_uuid}
-        p.hits=full
-        p.limit=-1
-    '''.replace(" ", "").replace('"', '\\"').split("\n")
+class ImportPlan:
+
+    def __init__(self, users, groups):
+        self.users = users
+        self.groups = groups
+        # csv line -> groups to add, only for rows which need any write
+        self.rows = {}
+        self.creates = set()
+        self.adds = {}
+        self.planned = set()
+        self.unknown = {}
+        # group -> users which are members, but not in the userlist for that group
+        self.extras = {}
+        # memberships which reconcile removes, and csv line -> extra groups of rows without other writes
+        self.removes = {}
+        self.pending = {}
+        # groups named in the userlist, and users which are on more than one row
+        self.listed = set()
+        self.seen = set()
+        self.duplicates = set()
+        self.extra = 0
+        self.unchanged = 0
+        # rows with an unknown group, which are not added to any group
+        self.skipped = 0
+        self.invalid = 0
 
-    criteria = list(filter(None, criteria))
+        return
 
-    try:
-        res = query_builder(criteria)
+    def add(self, user, out):
+        username = user.username
+        names = [group_name for group_name in user.groups.split('|') if group_name]
+        u = self.users.get(username, "rep:authorizableId")
+        if username in self.seen:
+            self.duplicates.add(username)
+        self.seen.add(username)
+
+        if u is None and not username in self.creates:
+            self.creates.add(username)
+            self.rows[user.line] = []
+            out.write(json.dumps({"op": "create", "line": user.line, "user": username}) + "\n")
+
+        current = set()
+        if u is not None:
+            current = set(group["rep:authorizableId"] for group in self.groups.groups_having(u["jcr:uuid"]))
+            for group_name in sorted(current - set(names)):
+                self.extra += 1
+                out.write(json.dumps({"op": "extra", "line": user.line, "user": username, "group": group_name}) + "\n")
+
+        # like the import, a row with an unknown group is not added to any group
+        unknown = [group_name for group_name in names if self.groups.get(group_name, "rep:authorizableId") is None]
+        for group_name in unknown:
+            self.unknown[group_name] = self.unknown.get(group_name, 0) + 1
+            out.write(json.dumps({"op": "unknown", "line": user.line, "user": username, "group": group_name}) + "\n")
+        if unknown:
+            self.skipped += 1
+
+        self.listed.update(names)
+        extras = set()
+        if not unknown:
+            # memberships of a row with an unknown group are left as they are
+            extras = current - set(names)
+            for group_name in sorted(extras):
+                self.extras.setdefault(group_name, []).append(username)
+            for group_name in names:
+                if group_name in current or (username, group_name) in self.planned:
+                    continue
+                self.planned.add((username, group_name))
+                self.adds[group_name] = self.adds.get(group_name, 0) + 1
+                self.rows.setdefault(user.line, []).append(group_name)
+                out.write(json.dumps({"op": "add", "line": user.line, "user": username, "group": group_name}) + "\n")
+
+        if not user.line in self.rows and not unknown:
+            self.unchanged += 1
+            if extras:
+                self.pending[user.line] = extras
 
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
+        return
 
-    return res
+    def reconcile(self, scope):
+        # the groups of a row are the complete groups of its user, so another row of that user would lose its groups
+        if self.duplicates:
+            raise UserMigrationError(f"users on more than one row can't be reconciled: {', '.join(sorted(self.duplicates))}")
 
-def get_group(groupname):
-    criteria = f'''
-        path=/home/groups
-        type=rep:Group
-        property=rep:principalName
-        property.value={groupname}
-        p.hits=full
-        p.limit=-1
-    '''.replace(" ", "").replace('"', '\\"').split("\n")
-    criteria = list(filter(None, criteria))
+        # extra memberships are removed from the groups of the scope, and their rows are no longer unchanged
+        self.removes = {group_name: user_name_list for group_name, user_name_list in self.extras.items() if group_name in scope}
+        self.unchanged -= len([extras for extras in self.pending.values() if extras & scope])
 
-    try:
-        res = query_builder(criteria)
+        return
 
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        res = None
-        sys.exit(1)
+    def requests(self, batch=None):
+        removes = {group_name: len(user_name_list) for group_name, user_name_list in self.removes.items()}
+        if batch is None:
+            return len(self.creates) + sum(self.adds.values()) + sum(removes.values())
 
-    return res
+        # adds and removes of a group share the requests of that group
+        counts = [self.adds.get(group_name, 0) + removes.get(group_name, 0) for group_name in set(self.adds) | set(removes)]
 
-def get_uuid_by_username(username):
-    criteria = f'''
-        path=/home/users
-        type=rep:User
-        property=rep:principalName
-        property.value={username}
-        p.hits=full
-    '''.replace(" ", "").replace('"', '\\"').split("\n")
-    criteria = list(filter(None, criteria))
+        return len(self.creates) + sum(math.ceil(count / batch["size"]) for count in counts)
 
-    try:
-        res = query_builder(criteria)
-        log.debug(f"username: {username}, uuid: " + res[0]["jcr:uuid"])
+    def report(self, target, batch, latency, concurrency, max_rps):
+        requests = self.requests(batch)
+        duration = requests * latency / max(concurrency, 1)
+        if max_rps:
+            duration = max(duration, requests / max_rps)
 
-    except IndexError as err:
-        log.error("jcr:uuid property don't be found in the response")
-        log.info(f"res: {res}")
-        sys.exit(1)
-        
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
+        removes = sum([len(user_name_list) for user_name_list in self.removes.values()])
+        log.info(
+                f"plan for {target}: create {len(self.creates)} users, add {sum(self.adds.values())} memberships, "
+                + (f"remove {removes} memberships, " if removes else "") + f"{self.unchanged} rows unchanged, {self.skipped} rows skipped"
+            )
+        log.info(f"extra memberships which are not in the userlist (kept): {self.extra - removes}")
+        for group_name, count in sorted(self.unknown.items()):
+            log.warning(f"unknown group: {group_name} ({count} rows)")
+        log.info(f"estimated write requests: {requests}, duration: {duration:.1f}s")
+
+        return
 
-    return res[0]["jcr:uuid"]
+def plan_import(config, target, userlist, um=None):
+    # the desired state of the userlist is compared with one bulk read of the environment
+    users, groups = load_directories(config, target, um)
+    plan = ImportPlan(users, groups)
 
-# curl -u admin:admin -FaddMembers=testuser1 http://localhost:4502/home/groups/t/testGroup.rw.html
-def add_user_to_group(username, group_path):
-    criteria = f'''
-        addMembers={username}
-    '''.replace(" ", "").split("\n")
-    criteria = list(filter(None, criteria))
-    criteria = reduce(lambda a, b: f"{a} -F \"{b}\"", criteria, "")
+    with open(os.path.join(config["work_dir"], target, "plan.jsonl"), "w", encoding="utf-8") as out:
+        for user in userlist:
+            plan.add(user, out)
+    plan.invalid = userlist.errors
 
-    command = f"curl -k -sS -u {user}:{password} {url}{group_path}.rw.html {criteria}"
+    return plan
 
-    try:
-        log.debug(f"curl commnad: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if not result.returncode == 0:
-            log.error(result.stderr)
-            raise ValueError("os command failed")
+def planned_rows(userlist, plan):
+    # rows without planned writes are not passed to the import at all
+    for user in userlist:
+        if user.line in plan.rows:
+            yield user._replace(groups="|".join(plan.rows[user.line]))
 
-        log.info(f"add {username} to: {group_path}")
+class TargetRows:
 
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
+    # rows parsed once for several targets, seen with the username column of one target
+    def __init__(self, users, index, errors):
+        self.users = users
+        self.index = index
+        self.errors = errors
 
-    return
+        return
 
-# curl -u admin:admin -FcreateUser= -FauthorizableId=testuser -Frep:password=abc123 http://localhost:4502/libs/granite/security/post/authorizables
-# curl -u admin:admin -FcreateUser=testuser -FauthorizableId=testuser -Frep:password=abc123 \
-# -Fprofile/email=test@gmail.com \
-# -Fprofile/familyName=test \
-# -Fprofile/givenName=user \
-# http://localhost:4502/libs/granite/security/post/authorizables
+    def __iter__(self):
+        for user in self.users:
+            yield user._replace(username=user.usernames[self.index])
 
-# curl -u admin:admin -F "createUser=testuser" -F "authorizableId=testuser" -F "rep:password=abc123" \
-# -F "profile/email=test@gmail.com" \
-# -F "profile/familyName=test" \
-# -F "profile/givenName=user" \
-# http://localhost:4502/libs/granite/security/post/authorizables
+def import_target(config, target, userlist):
+    import asyncio
 
+    opt = migration_options(config, target)
+    batch = opt["batch"] if config.get("batch_members") else None
 
+    if config.get("offline"):
+        # without a measured latency, 0.1s per request is assumed
+        plan = plan_import(config, target, userlist)
+        plan.report(target, batch, 0.1, opt["workers"], opt["rate"].get("max_rps", 0))
+        return plan, None
 
-def create_user(username, pwd, familyName, givenName, email):
-    criteria = f'''
-        createUser={username}
-        authorizableId={username}
-        rep:password={pwd}
-        profile/email={email}
-        profile/familyName={familyName}
-        profile/givenName={givenName}
-    '''.replace(" ", "").replace('"', '\\"').split("\n")
-    criteria = list(filter(None, criteria))
-    criteria = reduce(lambda a, b: f"{a} -F \"{b}\"", criteria, "")
+    # generage UserMigration object
+    um = UserMigration(opt)
+    plan = plan_import(config, target, userlist, um)
+
+    # the latency of the bulk read is used to estimate the writes
+    concurrency = opt["concurrency"] if config.get("async") else min(um.workers, um.rate.opt["max_in_flight"])
+    plan.report(target, batch, um.rate.percentile(0.5), concurrency, um.rate.opt["max_rps"])
+    if config["dryrun"]:
+        log.info(f"dry run: nothing was written to {target}, run with --execute to apply this plan")
+        report_connections(um, config)
+        um.close()
+        return plan, None
+
+    journal = Journal(journal_path(config, target), config.get("resume"))
+    rows = planned_rows(userlist, plan)
+    if password_hash_options(config):
+        rows = hashed_rows(rows, password_hash_options(config))
+
+    if config.get("async"):
+        if config.get("batch_members"):
+            log.warning("batched membership writes are not supported by the asyncio client")
+        um.close()
+        summary = asyncio.run(async_import(config, target, rows, journal, plan, um.metrics))
+        journal.close()
+        return plan, summary
+
+    # the directories of the plan are reused, so that existence checks are set lookups
+    um.users, um.groups, um.groups_with_members = plan.users, plan.groups, True
+    um.user_ids = set(plan.users.index["rep:authorizableId"])
 
-    command = f"curl -k -sS -u {user}:{password} {url}/libs/granite/security/post/authorizables {criteria}"
+    # create user and add user to group
+    summary = ImportSummary()
+    with Progress(target, len(plan.rows), um.metrics, config.get("progress_interval", 5)) as progress:
+        if config.get("batch_members"):
+            # users of a chunk are created first, then their memberships are sent per group
+            batcher = MembershipBatcher(um, summary, journal)
+            for chunk in chunked(rows, um.batch["chunk"]):
+                run_parallel(progress.wrap(lambda user: import_user(um, user, summary, journal, batcher)), chunk, um.workers)
+                batcher.flush(um.workers)
+        else:
+            run_parallel(progress.wrap(lambda user: import_user(um, user, summary, journal)), rows, um.workers)
+
+    summary.count("unchanged", plan.unchanged)
+    summary.count("skipped", plan.skipped)
+    summary.count("invalid", plan.invalid)
+    summary.report(target)
+    report_connections(um, config)
+    um.close()
+    journal.close()
+
+    return plan, summary
+
+def fanout_import(config, targets):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the csv is parsed and validated once, and every environment is imported concurrently
+    # with its own session, rate controller and journal
+    userlist = UserlistReader(config["userlist"], targets, "import")
+    if password_hash_options(config):
+        # the rows are kept for all environments, so passwords are hashed once before they are kept
+        users = list(hashed_rows(userlist, password_hash_options(config)))
+        config = dict(config, hash_passwords=False)
+    else:
+        users = list(userlist)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {target: executor.submit(import_target, config, target, TargetRows(users, i, userlist.errors)) for i, target in enumerate(targets)}
+        for target, future in futures.items():
+            try:
+                results[target] = future.result()
+            except UserMigrationError as err:
+                log.critical(f"{target}: {err} ({err.__cause__ or 'no cause'})")
+                results[target] = (None, None)
+
+    # one report for all environments
+    report = {}
+    for target, (plan, summary) in results.items():
+        if plan is None:
+            report[target] = {"status": "failed"}
+        elif summary is None:
+            report[target] = {"status": "planned", "create": len(plan.creates), "add": sum(plan.adds.values()), "unchanged": plan.unchanged, "skipped": plan.skipped, "unknown groups": len(plan.unknown)}
+        else:
+            report[target] = dict({"status": "imported"}, **{key: summary.counts.get(key, 0) for key in summary.keys})
+        log.info(f"{target} - " + ", ".join([f"{key}: {value}" for key, value in report[target].items()]))
 
-    try:
-        log.debug(f"curl commnad: {command}")
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if not result.returncode == 0:
-            log.error(result.stderr)
-            raise ValueError("os command failed")
+    with open(str(pathlib.Path(f"./{config['work_dir']}/import_summary.json")), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
 
-        log.info(f"create user: {username}")
+    ok(all([result["status"] != "failed" for result in report.values()]), "import to " + ", ".join(targets))
 
-    except Exception as err:
-        log.error(f"Unexpected {err=}, {type(err)=}")
-        sys.exit(1)
+    return
+
+def on_import(config):
+    targets = target_list(config)
 
-    return result.returncode
+    if config.get("offline") and not config["dryrun"]:
+        raise UserMigrationError("a plan from the snapshot can't be executed, run without --offline")
 
+    if len(targets) > 1:
+        return fanout_import(config, targets)
 
-def initalize():
-    work_dir = config["work_dir"]
-    if not os.path.exists(work_dir): 
-        os.mkdir(work_dir)
+    # read userlist lazily
+    import_target(config, targets[0], UserlistReader(config["userlist"], targets[0], "import"))
 
     return
 
-def ok(evaluation, description):
-    if evaluation:
-        log.info(f"[ok] - {description}")
-    else:
-        log.info(f"[not ok] - {description}")
+class ReconcileSummary(ImportSummary):
+
+    keys = ["created", "existing", "failed", "added", "add failed", "removed", "remove failed", "unchanged", "skipped", "invalid"]
+
+def reconcile_operations(adds, removes, size):
+    # the exact difference of each group, chunked to at most size members per request
+    for group_name in sorted(set(adds) | set(removes)):
+        operations = [("add", user_name) for user_name in adds.get(group_name, [])] + [("remove", user_name) for user_name in removes.get(group_name, [])]
+        for chunk in chunked(operations, size):
+            yield group_name, [user_name for op, user_name in chunk if op == "add"], [user_name for op, user_name in chunk if op == "remove"]
+
+def reconcile_target(config, target, userlist):
+    opt = migration_options(config, target)
+    um = None if config.get("offline") else UserMigration(opt)
+    plan = plan_import(config, target, userlist, um)
+
+    # memberships are only removed from the groups of the scope, by default the groups named in the userlist
+    plan.reconcile(set(config.get("reconcile", {}).get("groups") or plan.listed))
+
+    # like the import, 0.1s per request is assumed without a measured latency
+    if um is None:
+        plan.report(target, opt["batch"], 0.1, opt["workers"], opt["rate"].get("max_rps", 0))
+        return plan, None
+    plan.report(target, opt["batch"], um.rate.percentile(0.5), min(um.workers, um.rate.opt["max_in_flight"]), um.rate.opt["max_rps"])
+    if config["dryrun"]:
+        log.info(f"dry run: nothing was written to {target}, run with --execute to apply this plan")
+        report_connections(um, config)
+        um.close()
+        return plan, None
+    if config.get("async"):
+        log.warning("reconcile is not supported by the asyncio client, the threaded client is used")
+
+    um.users, um.groups, um.groups_with_members = plan.users, plan.groups, True
+    um.user_ids = set(plan.users.index["rep:authorizableId"])
+
+    # missing users are created first, and only the users which exist afterwards are added to groups
+    summary = ReconcileSummary()
+    lock = threading.Lock()
+    adds = {}
+    def create(user):
+        if user.username in plan.creates:
+            try:
+                ret = um.create_user(user_info_of(user))
+            except UserMigrationError as err:
+                log.error(f"{user.username}: {err} ({err.__cause__ or 'no cause'})")
+                ret = None
+            if ret == 201:
+                summary.count("created")
+            elif ret == 401:
+                summary.count("existing")
+            else:
+                summary.count("failed")
+                log.warning(f"skipped to add {user.username} to groups")
+                return
+
+        with lock:
+            for group_name in user.groups.split("|"):
+                if group_name:
+                    adds.setdefault(group_name, []).append(user.username)
+
+        return
+
+    def send(operation):
+        group_name, add_list, remove_list = operation
+        try:
+            status = um.update_members(group_name, add_list, remove_list)
+        except UserMigrationError as err:
+            log.error(f"{group_name}: {err} ({err.__cause__ or 'no cause'})")
+            status = None
+
+        # a failed request is retried by the next run, which computes the difference again
+        if status == 200:
+            summary.count("added", len(add_list))
+            summary.count("removed", len(remove_list))
+        else:
+            summary.count("add failed", len(add_list))
+            summary.count("remove failed", len(remove_list))
+
+        return
+
+    with Progress(target, len(plan.rows), um.metrics, config.get("progress_interval", 5)) as progress:
+        rows = planned_rows(userlist, plan)
+        if password_hash_options(config):
+            rows = hashed_rows(rows, password_hash_options(config))
+        run_parallel(progress.wrap(create), rows, um.workers)
+    run_parallel(send, reconcile_operations(adds, plan.removes, opt["batch"]["size"]), um.workers)
+
+    summary.count("unchanged", plan.unchanged)
+    summary.count("skipped", plan.skipped)
+    summary.count("invalid", plan.invalid)
+    summary.report(target)
+    report_connections(um, config)
+    um.close()
+
+    return plan, summary
+
+def on_reconcile(config):
+    if config.get("offline") and not config["dryrun"]:
+        raise UserMigrationError("a plan from the snapshot can't be executed, run without --offline")
+
+    results = {}
+    for target in target_list(config):
+        try:
+            plan, summary = reconcile_target(config, target, UserlistReader(config["userlist"], target, "reconcile"))
+            results[target] = summary is None or not (summary.counts.get("failed") or summary.counts.get("add failed") or summary.counts.get("remove failed"))
+        except UserMigrationError as err:
+            log.critical(f"{target}: {err} ({err.__cause__ or 'no cause'})")
+            results[target] = False
+
+    ok(all(results.values()), "reconcile " + ", ".join(results))
 
     return
 
-def main():
-    global url, user, password
-    initalize()
+def export_memberships(users, groups, usernames):
+    # users and groups are fetched in bulk, and memberships are resolved in memory
+    for username in usernames:
+        u = users.get(username, "rep:authorizableId")
+        if u is None:
+            log.warning(f"{username} doesn't exist")
+            yield username, None, []
+            continue
 
-    url = "http://localhost:4502"
-    user = "admin"
-    password = "admin"
+        yield username, u, groups.groups_having(u["jcr:uuid"])
 
-    query_builder("")
-    sys.exit(0)
+class ExportWriter:
 
+    # one record per user is written through a buffered file, the file appears when the export completed
+    fields = ["username", "authorizableId", "uuid", "groups", "group_names"]
 
-    if config["mode"] == "import":
-        url=config["destination"]["url"]
-        user=config["destination"]["user"]
-        password=config["destination"]["password"]
-        source_env = config["source"]["name"]
-        env = config["destination"]["name"]
+    def __init__(self, path, format="csv", compress=False):
+        self.path = path
+        self.format = format
+        self.compress = compress
+        self.count = 0
+
+        return
 
+    def __enter__(self):
+        import gzip
 
-        # read userlist and get username
-        userlist = read_userlist(config["userlist"])
+        if self.compress:
+            self.file = gzip.open(self.path + ".tmp", "wt", encoding="utf-8", newline="")
+        else:
+            self.file = open(self.path + ".tmp", "w", encoding="utf-8", newline="", buffering=1 << 20)
 
-        # .
-        for row in userlist:
-            username = row[source_env]
-            new_username = row[env]
+        self.writer = csv.writer(self.file)
+        if self.format == "csv":
+            self.writer.writerow(self.fields)
 
-            input = str(pathlib.Path(f"./" + config["work_dir"] + f"/{source_env}/{username}.json"))
-            with open(input) as f:
-                group_info= json.load(f)
+        return self
 
-            # confirm all groups in json file exist
-            exist_all_group = True
-            for group in group_info:
-                if not get_group( group["rep:authorizableId"] ):
-                    log.warning( group["rep:authorizableId"] + " doesn't exist")
-                    exist_all_group = False
-                    break
-                
-            if not exist_all_group:
-                log.warning( "skip creating " + new_username)
-                break
+    def __exit__(self, exc_type, *args):
+        self.file.close()
 
-            # create user
-            if 0 == create_user(new_username, row["password"], row["firstname"], row["lastname"], row["email"] ):
-                for group in group_info:
-                    # add user to group
-                    g = get_group( group["rep:authorizableId"] )                    
-                    add_user_to_group(new_username, g[0]["jcr:path"])
+        if exc_type is None:
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            os.remove(self.path + ".tmp")
 
-            # query group list which user is belong to.
-            uuid = get_uuid_by_username(new_username)
-            group_list = get_groups_having_uuid(uuid)
-            log.debug(f"username: {new_username}, uuid: {uuid}, group_list: " + json.dumps(group_list))
-            if len(group_list) > 0:
-                output_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{env}"))
-                output = str(pathlib.Path(f"./" + f"{output_dir}/{new_username}.json"))
-                if not os.path.exists(output_dir): 
-                    os.mkdir(output_dir)
-                with open(output, 'w') as f:
-                    json.dump(group_list, f, indent=4)
+        return
 
+    def write(self, record):
+        if self.format == "csv":
+            self.writer.writerow([record[field] if not isinstance(record[field], list) else "|".join(record[field]) for field in self.fields])
+        else:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += 1
 
+        return
 
+def export_record(username, u, groups):
+    return {
+            "username": username,
+            "authorizableId": None if u is None else u.get("rep:authorizableId"),
+            "uuid": None if u is None else u.get("jcr:uuid"),
+            "groups": [group["rep:authorizableId"] for group in groups],
+            "group_names": [group_display_name(group) for group in groups]
+        }
 
+def write_export(config, target, users, groups, usernames):
+    # without --output, the memberships are logged as before
+    output = config.get("output")
+    if output is None:
+        for username, u, user_groups in export_memberships(users, groups, usernames):
+            groupname = [group_display_name(group) for group in user_groups]
+            log.info(f"{username}," + "|".join(groupname))
+        return
 
+    if not output in ["csv", "jsonl"]:
+        raise UserMigrationError(f"unknown output format: {output}, use csv or jsonl")
 
+    path = str(pathlib.Path(f"./{config['work_dir']}/{target}/export.{output}" + (".gz" if config.get("gzip") else "")))
+    with ExportWriter(path, output, config.get("gzip")) as writer:
+        for username, u, user_groups in export_memberships(users, groups, usernames):
+            writer.write(export_record(username, u, user_groups))
+    log.info(f"{writer.count} users are exported to {path}")
 
-    elif config["mode"] == "export":
+    return
 
-        url=config["source"]["url"]
-        user=config["source"]["user"]
-        password=config["source"]["password"]
-        env = config["source"]["name"]
+def on_export(config):
+    import asyncio
 
-        # read userlist
-        userlist = read_userlist(config["userlist"])
+    target = config["target"]
 
-        # query group list which user is belong to.
-        for row in userlist:
-            username = row[env]
-            uuid = get_uuid_by_username(username)
-            group_list = get_groups_having_uuid(uuid)
-            log.debug(f"username: {username}, uuid: {uuid}, group_list: " + json.dumps(group_list))
-            if len(group_list) > 0:
-                output_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{env}"))
-                output = str(pathlib.Path(f"./" + f"{output_dir}/{username}.json"))
-                if not os.path.exists(output_dir): 
-                    os.mkdir(output_dir)
+    # read userlist lazily and get username
+    userlist = UserlistReader(config["userlist"], target, "export")
+    usernames = (user.username for user in userlist)
 
-                with open(output, 'w') as f:
-                    json.dump(group_list, f, indent=4)
+    # snapshots are read and refreshed by the threaded client
+    if config.get("async") and (config.get("offline") or config.get("snapshot")):
+        log.warning("the snapshot is used without the asyncio client")
+    elif config.get("async"):
+        asyncio.run(async_export(config, target, usernames))
+        return
 
+    if config.get("offline"):
+        users, groups = load_directories(config, target)
     else:
-        source_env = config["source"]["name"]
-        destination_env = config["destination"]["name"]
-        source_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{source_env}"))
-        destination_dir = str(pathlib.Path(f"./" + config["work_dir"] + f"/{destination_env}"))
+        # generage UserMigration object
+        um = UserMigration(migration_options(config, target))
+        users, groups = load_directories(config, target, um)
 
-        # read userlist and get username
-        userlist = read_userlist(config["userlist"])
+        report_connections(um, config)
+        um.close()
 
-        # .
-        try:
-            for row in userlist:
-                source_username = row[source_env]
-                destination_username = row[destination_env]
+    # export group information
+    write_export(config, target, users, groups, usernames)
 
-                source_json = str(pathlib.Path(f"./{source_dir}/{source_username}.json"))
-                destination_json = str(pathlib.Path(f"./{destination_dir}/{destination_username}.json"))
+    return
 
-                with open(source_json) as f:
-                    _source_group= json.load(f)
-                    source_group = list(map(lambda x: x["rep:principalName"], _source_group))
-                    source_group.sort()
-                with open(destination_json) as f:
-                    _destination_group= json.load(f)
-                    destination_group = list(map(lambda x: x["rep:principalName"], _destination_group))
-                    destination_group.sort()
+def fetch_memberships(config, target):
+    # groups of every user of an environment, resolved from one bulk read of users and groups
+    if config.get("offline"):
+        users, groups = load_directories(config, target)
+    else:
+        um = UserMigration(migration_options(config, target))
+        users, groups = load_directories(config, target, um)
+        report_connections(um, config)
+        um.close()
+
+    memberships = {}
+    for uuid, user_groups in groups.members.items():
+        u = users.get(uuid, "jcr:uuid")
+        if u is not None:
+            memberships[u["rep:authorizableId"]] = [group["rep:authorizableId"] for group in user_groups]
+
+    existing = set(users.index["rep:authorizableId"])
+
+    return existing, memberships
+
+def compare_memberships(targets, rows, graphs):
+    # (row, group) pairs of every environment are compared as whole sets
+    pairs = {}
+    missing = {}
+    for i, target in enumerate(targets):
+        existing, memberships = graphs[target]
+        missing[target] = {line for line, usernames in rows if usernames[i] not in existing}
+        pairs[target] = {(line, group) for line, usernames in rows for group in memberships.get(usernames[i], [])}
+
+    common = set.intersection(*pairs.values())
+    only_in = {target: pairs[target] - common for target in targets}
+
+    differences = {}
+    for target in targets:
+        for line in missing[target]:
+            differences.setdefault(line, {"missing": [], "only_in": {}})["missing"].append(target)
+        for line, group in only_in[target]:
+            differences.setdefault(line, {"missing": [], "only_in": {}})["only_in"].setdefault(target, []).append(group)
+
+    summary = {
+        "environments": targets,
+        "users": len(rows),
+        "identical": len(rows) - len(differences),
+        "different": len(differences),
+        "missing": {target: len(missing[target]) for target in targets},
+        "only_in": {target: len(only_in[target]) for target in targets}
+    }
 
-                ok(source_group == destination_group, f"compare {source_username} with {destination_username}")
-                if not source_group == destination_group:
-                        log.warning("\n" + tabulate({source_env: source_group, destination_env: destination_group}, headers='keys'))
+    return differences, summary
 
+def on_compare(config):
+    from concurrent.futures import ThreadPoolExecutor
+
+    targets = target_list(config)
+    if len(targets) < 2:
+        targets = [env["name"] for env in config["environment"]]
+    if len(targets) < 2:
+        raise UserMigrationError("compare needs two or more environments")
+
+    # memberships of all environments are fetched concurrently while the csv is read
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {target: executor.submit(fetch_memberships, config, target) for target in targets}
+
+        userlist = UserlistReader(config["userlist"], targets, "compare")
+        rows = [(user.line, user.usernames) for user in userlist]
+
+        graphs = {target: future.result() for target, future in futures.items()}
+
+    differences, summary = compare_memberships(targets, rows, graphs)
+
+    # one line per user which differs between environments
+    output = str(pathlib.Path(f"./{config['work_dir']}/compare.jsonl"))
+    with open(output, "w", encoding="utf-8") as f:
+        for line, usernames in rows:
+            if line in differences:
+                diff = differences[line]
+                record = {
+                    "line": line,
+                    "users": dict(zip(targets, usernames)),
+                    "missing": diff["missing"],
+                    "only_in": {target: sorted(groups) for target, groups in diff["only_in"].items()}
+                }
+                f.write(json.dumps(record) + "\n")
+
+    with open(str(pathlib.Path(f"./{config['work_dir']}/compare_summary.json")), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=4)
+
+    ok(summary["different"] == 0, "compare " + " with ".join(targets))
+    log.info(f"users: {summary['users']}, identical: {summary['identical']}, different: {summary['different']}")
+    for target in targets:
+        log.info(f"{target} - missing users: {summary['missing'][target]}, memberships only in {target}: {summary['only_in'][target]}")
+    log.info(f"differences are written to {output}")
 
-        except Exception as err:
-            log.error(f"Unexpected {err=}, {type(err)=}")
-            sys.exit(1)
-            
-    return 0
+    return
 
-main()
+def oak_uuid(authorizable_id):
+    # Oak derives jcr:uuid of an authorizable from its lowercased id, like java.util.UUID.nameUUIDFromBytes
+    import hashlib
+    import uuid
 
+    return str(uuid.UUID(bytes=hashlib.md5(authorizable_id.lower().encode("utf-8")).digest(), version=3))
 
+def package_user_path(root, authorizable_id):
+    # users are spread over 256 folders by the md5 of their id, so that the paths are the same in every build
+    import hashlib
 
-sys.exit()
-# define global variables
-_filename = os.path.basename(__file__)
-filename = os.path.splitext(_filename)[0]
-subdir = f"{filename}"
-config_file = str(pathlib.Path(f"./{subdir}/{filename}.yaml"))
-data_file = str(pathlib.Path(f"./{subdir}/uri_list.txt"))
-work_dir = str(pathlib.Path(f"./{subdir}/tmp"))
+    return f"{root}/{hashlib.md5(authorizable_id.encode('utf-8')).hexdigest()[:2]}/{authorizable_id}"
 
-# define logger
-log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG)
-rh = logging.handlers.RotatingFileHandler(
-        f'{filename}.log', 
-        encoding='utf-8',
-        maxBytes=1024000,
-        backupCount=2
-    )
-log.addHandler(rh)
-
-
-def construct_curl(config, path):
-
-    # initialize config
-    default = {
-        "cmd": f"curl -sS -k ",
-        "proto": "https",
-        "domain": "www.google.com",
-        "user-agent": "Mozilla/5.0 from test_request",
-        "header": [],
-        "write_out": ["http_code", "time_total"],
-        "cookie": []
-    }
-    default.update(config)
+def docview_value(value):
+    # a single value of the FileVault docview format, a leading "{" would be read as a type
+    value = value.replace("\\", "\\\\")
+    if value.startswith("{"):
+        value = "\\" + value
 
-    options = []
-    options.append(["--output-dir", work_dir])
-    options.append(["--output", os.getpid()])
+    return value
 
-    # make cookie
-    cookie = reduce(lambda a, b: a + f"{b[0]}={b[1]};", default['cookie'], "")
-    options.append(["--cookie", cookie])
+def docview_attributes(properties, indent):
+    from xml.sax.saxutils import quoteattr
 
-    # user-agent
-    options.append(["--user-agent", default['user-agent']])
+    return "".join([f"\n{indent}{name}={quoteattr(value, {chr(10): '&#xa;', chr(13): '&#xd;', chr(9): '&#x9;'})}" for name, value in properties])
 
-    # make write_out
-    write_out_options = [
-         "content_type", "errormsg", "exitcode", "filename_effective", "ftp_entry_path", "http_code", "http_connect", "http_version", "local_ip", "local_port", "method", "num_connects", "num_headers", "num_redirects", "onerror", "proxy_ssl_verify_result", "redirect_url", "referer", "remote_ip", "remote_port", "response_code", "scheme", "size_download", "size_header", "size_request", "size_upload", "speed_download", "speed_upload", "ssl_verify_result", "stderr", "stdout", "time_appconnect", "time_connect", "time_namelookup", "time_pretransfer", "time_redirect", "time_starttransfer", "time_total", "url", "url_effective", "urlnum"
-    ]
-    write_out = "\\n" + reduce(lambda a, b: a + b + "# %{" + b + "}\\n", filter(lambda x: x in write_out_options, default["result"]), "")
-    options.append(["--write-out", write_out])
+def docview(properties, children=""):
+    root = '<jcr:root xmlns:jcr="http://www.jcp.org/jcr/1.0" xmlns:nt="http://www.jcp.org/jcr/nt/1.0" xmlns:rep="internal"'
+    body = f">\n{children}</jcr:root>\n" if children else "/>\n"
 
-    # construct request header
-    for header in default['header']:
-        options.append(["--header", f"{header[0]}: {header[1]}"])
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n' + root + docview_attributes(properties, "    ") + body).encode("utf-8")
 
-    # construct uri
-    if re.match("\S+://", path):
-        uri = path
-    else:
-        path = urllib.parse.quote(path)
-        uri = f"{default['proto']}://{default['domain']}{path}"
-    options.append(["--dump-header -", uri])
+def user_node(user, uuid, password):
+    children = ""
+    profile = [(name, docview_value(value)) for name, value in [("email", user.email), ("familyName", user.familyName), ("givenName", user.givenName)] if value]
+    if profile:
+        children = "    <profile" + docview_attributes([("jcr:primaryType", "nt:unstructured")] + profile, "        ") + "/>\n"
 
-    # make command
-    return  reduce(lambda a, b: f'{a} {b[0]} "{b[1]}"', options, default['cmd'])
+    return docview([
+            ("jcr:primaryType", "rep:User"),
+            ("jcr:uuid", uuid),
+            ("rep:authorizableId", docview_value(user.username)),
+            ("rep:principalName", docview_value(user.username)),
+            ("rep:password", docview_value(password))
+        ], children)
 
+def deflate(name, data, level):
+    # entries are compressed where they are rendered, the raw deflate stream of zip files
+    import zlib
 
-def curl(command):
-    log.debug(command)
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    if not result.returncode == 0:
-        log.error(result.stderr)
-        
-    res_header = {}
-    res_command = {}
-    html = None
-    for line in result.stdout.split("\n"):
-        match = re.findall(r'^(HTTP\S+).+(\d\d\d)\s*$', line)
-        if len(match) != 0:
-            continue
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
 
-        match = re.findall(r'^(\S+): (.+)$', line)
-        if len(match) != 0:
-            for array in match:
-                res_header[array[0]] = array[1]
-            continue
+    return name, zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
 
-        match = re.findall(r'^(\S+)# (.+)$', line)
-        if len(match) != 0:
-            for array in match:
-                res_command[array[0]] = array[1]
-            continue
+def render_users(users, root, level, hash_opt=None):
+    # runs in a worker process, the rows of a chunk are rendered, hashed and compressed in csv order
+    return [
+            deflate(f"jcr_root{package_user_path(root, user.username)}/.content.xml", user_node(user, oak_uuid(user.username), hash_password(user.password or "", hash_opt)), level)
+            for user in users
+        ]
 
-    if "content-type" in res_header.keys() and re.match("text/html", res_header["content-type"]):
-        with open(str(pathlib.Path(f"./{subdir}/tmp/{os.getpid()}")), "r", encoding="utf-8") as f:
-            html = f.read()
+def ordered_results(executor, func, chunks, window):
+    # at most window chunks are in flight, and the results are returned in the order of the chunks
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(func, chunk))
+        if len(pending) >= window:
+            yield pending.popleft().result()
 
-    return {
-        "res_header": res_header,
-        "res_command": res_command,
-        "html": html
-    }
+    while pending:
+        yield pending.popleft().result()
 
+    return
 
-# define worker
-def worker(uri, config, result_list):
+class PackageWriter:
 
-    command = construct_curl(config, uri)
-    result = curl(command)
+    # name: package name (user_creation_<target> when empty), root: folder of the new users
+    defaults = {"name": "", "group": "user_creation", "version": "1.0", "root": "/home/users/imported", "chunk": 1000, "compresslevel": 6}
 
-    log.debug(f"PID: {os.getpid()}")
-    log.debug("res_header\n" + yaml.dump(result["res_header"]))
-    log.debug("res_command\n" + yaml.dump(result["res_command"]))
+    # 1980-01-01 00:00 in dos format, so that the same csv and snapshot give the same zip
+    dos_date = 33
 
-    output = []
-    for key in config["result"]:
-        if key in result["res_header"]:
-            output.append(result["res_header"][key])
-            continue
+    def __init__(self, path, opt):
+        # compressed entries are appended as they come, only the central directory is kept in memory
+        self.path = path
+        self.opt = opt
+        self.file = open(path + ".tmp", "wb")
+        self.offset = 0
+        self.central = []
+        self.filters = []
 
-        if key in result["res_command"]:
-            output.append(result["res_command"][key])
-            continue
+        return
 
-        match = re.findall(r'^m(.)(.+)\1$', key)
-        if len(match) != 0 and result["html"] is not None:
-            regexp = match[0][1]
-            match = re.findall(regexp, result["html"], re.IGNORECASE)
-            if match:
-                output.append(match[0])
-            else:
-                output.append("")
-            continue
+    def append(self, name, crc, size, compressed):
+        import struct
 
-        # append blank if key doesn't match all condition
-        output.append("N/A")
+        encoded = name.encode("utf-8")
+        flags = 0 if name.isascii() else 0x800
+        if self.offset > 0xFFFFFFFF or len(compressed) > 0xFFFFFFFF:
+            raise UserMigrationError(f"{self.path} would be larger than 4GB, split the userlist")
 
-    
-    time.sleep(config["config"]["wait"])
-    return result_list.append(output)
+        header = struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, flags, 8, 0, self.dos_date, crc, len(compressed), size, len(encoded), 0)
+        self.central.append(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, 3 << 8 | 20, 20, flags, 8, 0, self.dos_date,
+                crc, len(compressed), size, len(encoded), 0, 0, 0, 0, 0o644 << 16, self.offset
+            ) + encoded)
+        self.write_bytes(header + encoded)
+        self.write_bytes(compressed)
 
+        return
 
-if __name__ == "__main__":
-    if not os.path.exists(subdir): 
-        os.mkdir(subdir)
-    if os.path.exists(work_dir): 
-        shutil.rmtree(work_dir)
-    if not os.path.exists(work_dir): 
-        os.mkdir(work_dir)
-
-    with open(config_file, "r", encoding="utf-8") as file:
-        config = {
-            "config": {"logLevel": 1, "process": 8, "wait": 0.5}
-        }
-        config = deepmerge(config, yaml.safe_load(file))
+    def write(self, name, data):
+        self.append(*deflate(name, data, self.opt["compresslevel"]))
+
+        return
 
-    with open(data_file, "r", encoding="utf-8") as f:
-        uris = f.read().split("\n")
+    def write_bytes(self, data):
+        self.file.write(data)
+        self.offset += len(data)
 
-        print(uris.count("#__END__"))
-        if "#__END__" in uris:
-            position = uris.index("#__END__")
-            uris = uris[0:position]
+        return
 
-        uris = list(filter(lambda a: not re.match("^$|^#", a), uris))
+    def folders(self):
+        # merge: existing users below the root are not changed
+        self.filters.append((self.opt["root"], "merge"))
+        self.write(f"jcr_root{self.opt['root']}/.content.xml", docview([("jcr:primaryType", "rep:AuthorizableFolder")]))
+        for i in range(256):
+            self.write(f"jcr_root{self.opt['root']}/{i:02x}/.content.xml", docview([("jcr:primaryType", "rep:AuthorizableFolder")]))
 
-    while len(uris) != 0:
-        with multiprocessing.Manager() as manager:
-            # list which is pushed to worker result
-            result_list = manager.list()
+        return
 
-            # process list
-            process = []
+    def group(self, group, members):
+        # update: the existing group takes rep:members of the package, which has the current members as well
+        self.filters.append((group["jcr:path"], "update"))
+        self.write(f"jcr_root{group['jcr:path']}/.content.xml", docview([
+                ("jcr:primaryType", "rep:Group"),
+                ("jcr:uuid", group["jcr:uuid"]),
+                ("rep:authorizableId", docview_value(group["rep:authorizableId"])),
+                ("rep:principalName", docview_value(group.get("rep:principalName") or group["rep:authorizableId"])),
+                ("rep:members", "{WeakReference}[" + ",".join(members) + "]")
+            ]))
 
-            for i in range(config["config"]["process"]):
-                if len(uris) == 0:
-                    break
+        return
+
+    def close(self, name):
+        import struct
+        from xml.sax.saxutils import escape, quoteattr
+
+        filters = "".join([f"    <filter root={quoteattr(root)} mode=\"{mode}\"/>\n" for root, mode in self.filters])
+        self.write("META-INF/vault/filter.xml", (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<workspaceFilter version="1.0">\n{filters}</workspaceFilter>\n'
+            ).encode("utf-8"))
+
+        entries = {"name": name, "group": self.opt["group"], "version": str(self.opt["version"]), "requiresRoot": "false"}
+        self.write("META-INF/vault/properties.xml", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+                '<!DOCTYPE properties SYSTEM "http://java.sun.com/dtd/properties.dtd">\n'
+                '<properties>\n' + "".join([f'<entry key="{key}">{escape(value)}</entry>\n' for key, value in entries.items()]) + '</properties>\n'
+            ).encode("utf-8"))
+
+        # central directory, with the zip64 end records when there are 65535 entries or more
+        start = self.offset
+        for entry in self.central:
+            self.write_bytes(entry)
+        size = self.offset - start
+        count = len(self.central)
+        if count >= 0xFFFF:
+            zip64 = self.offset
+            self.write_bytes(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            self.write_bytes(struct.pack("<IIQI", 0x07064b50, 0, zip64, 1))
+        self.write_bytes(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), size, start, 0))
+
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+        return
+
+def package_target(config, target, userlist):
+    import hashlib
+    import re
+    from concurrent.futures import ProcessPoolExecutor
+
+    opt = deepmerge(PackageWriter.defaults, config.get("package", {}))
+    name = opt["name"] or f"user_creation_{target}"
+    path = str(pathlib.Path(f"./{config['work_dir']}/{target}/{name}-{opt['version']}.zip"))
+
+    # the package is built from the snapshot, --snapshot refreshes it first
+    if config.get("snapshot") and not config.get("offline"):
+        um = UserMigration(migration_options(config, target))
+        users, groups = load_directories(config, target, um)
+        um.close()
+    else:
+        users, groups = load_directories(dict(config, offline=True), target)
+
+    counts = {"users": 0, "existing": 0, "duplicated": 0, "invalid": 0, "memberships": 0}
+    unknown = {}
+    members = {}
+    seen = set()
+
+    def rows():
+        for user in userlist:
+            # the id is the name of the node and of the file in the package
+            if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9._@-]*", user.username):
+                log.warning(f"{user.username}: the id can't be a node name of the package, skipped")
+                counts["invalid"] += 1
+                continue
+            if user.username in seen:
+                counts["duplicated"] += 1
+                continue
+            seen.add(user.username)
+
+            u = users.get(user.username, "rep:authorizableId")
+            uuid = oak_uuid(user.username) if u is None else u["jcr:uuid"]
+
+            # like the import, a row with an unknown group is not added to any group
+            names = [group_name for group_name in user.groups.split("|") if group_name]
+            missing = [group_name for group_name in names if groups.get(group_name, "rep:authorizableId") is None]
+            for group_name in missing:
+                unknown[group_name] = unknown.get(group_name, 0) + 1
+            if not missing:
+                for group_name in names:
+                    group = groups.get(group_name, "rep:authorizableId")
+                    if not group in groups.groups_having(uuid):
+                        members.setdefault(group["jcr:path"], []).append(uuid)
+                        counts["memberships"] += 1
+
+            if u is not None:
+                counts["existing"] += 1
+                continue
+            counts["users"] += 1
+            yield user
+
+        return
+
+    writer = PackageWriter(path, opt)
+    writer.folders()
+    workers = config.get("workers") or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        render = functools.partial(render_users, root=opt["root"], level=opt["compresslevel"], hash_opt=password_hash_options(config))
+        for entries in ordered_results(executor, render, chunked(rows(), opt["chunk"]), workers * 2):
+            for entry in entries:
+                writer.append(*entry)
+
+    # the group keeps its current members, because the install replaces rep:members
+    for group_path in sorted(members):
+        group = groups.get(group_path, "jcr:path")
+        current = group.get("rep:members", [])
+        if isinstance(current, str):
+            current = [current]
+        writer.group(group, list(current) + members[group_path])
+    writer.close(name)
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+
+    log.info(f"package for {target}: {path}, {os.path.getsize(path)} bytes, sha256 {sha256.hexdigest()}")
+    log.info(
+            f"new users: {counts['users']}, existing users (skipped): {counts['existing']}, memberships to add: {counts['memberships']} "
+            f"in {len(members)} groups, duplicated rows: {counts['duplicated']}, invalid rows: {counts['invalid'] + userlist.errors}"
+        )
+    for group_name, count in sorted(unknown.items()):
+        log.warning(f"unknown group: {group_name} ({count} rows)")
+
+    return path
+
+def on_package(config):
+    # the package is only written to work_dir, it is installed with the package manager
+    for target in target_list(config):
+        package_target(config, target, UserlistReader(config["userlist"], target, "package"))
+
+    return
+
+class Profiler:
+
+    # --profile cpu: cProfile of every thread, --profile mem: tracemalloc allocation sites,
+    # both with the time of each phase, reports are written to work_dir
+    def __init__(self, kind, work_dir):
+        self.kind = kind
+        self.work_dir = work_dir
+        self.profiles = []
+        self.lock = threading.Lock()
+
+        if kind not in [None, "cpu", "mem"]:
+            raise UserMigrationError(f"unknown profile: {kind}, use cpu or mem")
+
+        return
+
+    def __enter__(self):
+        if self.kind is None:
+            return self
+
+        # every profiled run starts from zero, and the handlers are restored on exit
+        phases.enabled = True
+        phases.totals = {}
+        self.handlers = list(log.handlers)
+        for handler in self.handlers:
+            handler.handle = self.measured_handle(handler.handle)
+
+        self.started = (time.perf_counter(), time.process_time())
+        if self.kind == "cpu":
+            import cProfile
+
+            # before 3.12 a profiler sees only its own thread, so that each worker thread gets one
+            self.profile = cProfile.Profile()
+            if sys.version_info < (3, 12):
+                threading.setprofile(self.profile_thread)
+            self.profile.enable()
+        else:
+            import tracemalloc
+
+            # the heap is kept while it grows, so that the report shows the largest state of the run
+            tracemalloc.start(10)
+            self.snapshot = None
+            self.snapshot_size = 0
+            self.stopped = threading.Event()
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+        return self
+
+    def measured_handle(self, handle):
+        def measured(record):
+            with phases.measure("logging"):
+                return handle(record)
+
+        return measured
+
+    def sample(self):
+        import tracemalloc
 
-                process.append(multiprocessing.Process(target=worker, args=(uris.pop(0), config, result_list)))
-                process[i].start()
+        while not self.stopped.wait(1.0):
+            current = tracemalloc.get_traced_memory()[0]
+            if current > self.snapshot_size * 1.1:
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_size = current
 
-            for p in process:
-                p.join()
+        return
+
+    def profile_thread(self, frame, event, arg):
+        import cProfile
+
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def __exit__(self, *args):
+        if self.kind is None:
+            return
+
+        elapsed = (time.perf_counter() - self.started[0], time.process_time() - self.started[1])
+        if self.kind == "cpu":
+            self.profile.disable()
+            threading.setprofile(None)
+            report = self.cpu_report()
+        else:
+            report = self.mem_report()
+
+        phases.enabled = False
+        for handler in self.handlers:
+            # the wrapper is an attribute of the instance, the method of the class shows through again
+            del handler.handle
+        report = self.phase_report(elapsed) + report
+
+        with open(os.path.join(self.work_dir, f"profile.{self.kind}.txt"), "w", encoding="utf-8") as f:
+            f.write(report)
+        log.info(f"profile is written to {os.path.join(self.work_dir, f'profile.{self.kind}.txt')}")
+
+    def phase_report(self, elapsed):
+        totals = dict(phases.totals)
+        with open(os.path.join(self.work_dir, "profile.phases.json"), "w", encoding="utf-8") as f:
+            json.dump({"elapsed": elapsed[0], "cpu": elapsed[1], "phases": totals}, f, indent=4)
+
+        # wall time of the phases is summed over threads, cpu time shows what the client itself costs
+        lines = [f"elapsed: {elapsed[0]:.3f}s, process cpu: {elapsed[1]:.3f}s", "", f"{'phase':<12}{'calls':>10}{'wall':>12}{'cpu':>12}"]
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]["cpu"]):
+            lines.append(f"{name:<12}{total['calls']:>10}{total['wall']:>11.3f}s{total['cpu']:>11.3f}s")
+        other = elapsed[1] - sum([total["cpu"] for total in totals.values()])
+        lines.append(f"{'other':<12}{'':>10}{'':>12}{max(other, 0):>11.3f}s")
+
+        for line in lines[2:]:
+            log.info(line)
+
+        return "\n".join(lines) + "\n\n"
+
+    def cpu_report(self):
+        import pstats
+        import io
+
+        for profile in self.profiles:
+            profile.create_stats()
+        stats = pstats.Stats(self.profile)
+        for profile in self.profiles:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(self.work_dir, "profile.cpu.pstats"))
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("tottime").print_stats(30)
+        stats.sort_stats("cumulative").print_stats(30)
+
+        return out.getvalue()
+
+    def mem_report(self):
+        import tracemalloc
+        import inspect
+
+        self.stopped.set()
+        self.sampler.join()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self.snapshot
+        if snapshot is None or current > self.snapshot_size:
+            snapshot, self.snapshot_size = tracemalloc.take_snapshot(), current
+        tracemalloc.stop()
+
+        # an allocation belongs to the innermost phase function on its traceback
+        ranges = []
+        for name, funcs in phases.functions.items():
+            for func in funcs:
+                lines, start = inspect.getsourcelines(func)
+                ranges.append((inspect.getsourcefile(func), start, start + len(lines), name))
+        logging_dir = os.path.dirname(logging.__file__)
+
+        def phase_of(traceback):
+            for frame in reversed(traceback):
+                if frame.filename.startswith(logging_dir):
+                    return "logging"
+                for filename, start, end, name in ranges:
+                    if frame.filename == filename and start <= frame.lineno < end:
+                        return name
+
+            return "other"
+
+        by_phase = {}
+        statistics = snapshot.statistics("traceback")
+        for stat in statistics:
+            name = phase_of(stat.traceback)
+            by_phase[name] = by_phase.get(name, 0) + stat.size
+
+        lines = [
+            f"traced memory: peak {peak / 1024 / 1024:.1f} MB, at the end {current / 1024 / 1024:.1f} MB",
+            "",
+            f"allocated by phase at the largest snapshot ({self.snapshot_size / 1024 / 1024:.1f} MB):"
+        ]
+        for name, size in sorted(by_phase.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<12}{size / 1024:>12.1f} KiB")
+            log.info(f"memory of {name}: {size / 1024:.1f} KiB")
+        lines += ["", "top allocation sites:"]
+        for stat in snapshot.statistics("lineno")[:30]:
+            lines.append(f"  {stat}")
+        log.info(f"traced memory peak: {peak / 1024 / 1024:.1f} MB")
+
+        return "\n".join(lines) + "\n"
+
+def run(config):
+    # runs the mode of config, also when this module is used as a library
+    initalize(config)
+
+    event_hander = {"import": on_import, "reconcile": on_reconcile, "package": on_package, "export": on_export, "compare": on_compare}
+    for key in event_hander.keys():
+        if config["mode"] == key:
+            with Profiler(config.get("profile"), config["work_dir"]):
+                event_hander[config["mode"]](config)
 
-            print(tabulate(result_list, headers=config["result"]))
+    return
+
+def main():
+    setup_logging()
+    config = load_config()
+
+    try:
+        run(config)
+    except UserMigrationError as err:
+        # bad input, or the environment is unreachable even after the retries
+        log.critical(f"{err} ({err.__cause__})" if err.__cause__ else str(err))
+        sys.exit(1)
 
+    sys.exit()
 
+if __name__ == "__main__":
+    main()